@@ -1,31 +1,104 @@
 from fastapi import FastAPI, Form, Cookie
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.requests import Request
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from datetime import datetime
 
-import pandas as pd
-import numpy as np
+import asyncio
+import json
+import os
+import time
+import plotly
+import plotly.offline
 
-import sqlite3
 import re
 
 from models import User, Tag
-from database import initialize_db, generate_plots, update_preferences, update_anchor_time, insert_new_tag
-from utility import detect_time_frame, handle_cookie, check_cookie
-from parser import parse_formula
+from database import initialize_db, poll_data, settle_samples, generate_plots, get_window, get_plot_series, update_preferences, update_resolution, update_anchor_time, create_formula_tag, append_frame
+from ingest import CsvChunker, UploadProgress
+from utility import detect_time_frame, handle_cookie, check_cookie, to_epoch_us, from_epoch_us, encode_float64
+from downsample import MAX_POINTS, METHODS
+from workers import run_blocking
+from pool import pool
+from parser import is_tag_id
+from catalog import catalog
+from live import LIVE_POLL_SECONDS, hub
+
+#static files with a long browser cache for the versioned plotly.js bundle
+class CachedStaticFiles(StaticFiles):
+   def file_response(self, full_path, stat_result, scope, status_code = 200):
+      response = super().file_response(full_path, stat_result, scope, status_code)
+      if os.path.basename(full_path) == os.path.basename(PLOTLY_JS):
+         response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+      return response
+
+#plotly.js is served once from /static instead of being embedded in every plot
+#the file name carries the plotly version, so upgrading plotly writes a new file and busts the browser cache
+PLOTLY_JS = f"static/plotly-{plotly.__version__}.min.js"
+if not os.path.exists(PLOTLY_JS):
+   with open(PLOTLY_JS, "w", encoding="utf-8") as f:
+      f.write(plotly.offline.get_plotlyjs())
 
 #create the fastapi instance, connect CSS, Jinja2 templates to return HTML, and initialize databases
 app = FastAPI()
 templates = Jinja2Templates('./templates')
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-con_data = sqlite3.connect("process_data.db")
+app.mount("/static", CachedStaticFiles(directory="static"), name="static")
 
 #dictionary to store user sessions
 user_sessions = {}
 
+#progress of the latest csv upload of every session
+uploads = {}
+
+#loads new rows from data.csv with the writer connection so ingestion never runs inside a page request
+def ingest_data() -> None:
+   with pool.writer() as con:
+      initialize_db(con)
+
+#runs a database function on the worker pool with the read connection of the worker thread
+#blocking sqlite, pandas and plotly work never runs on the event loop
+async def run_db(user: User, fn, *args):
+   return await run_blocking(user.session_token, lambda: fn(pool.reader(), *args))
+
+#runs a database function that writes on the worker pool with the single writer connection
+async def run_write(user: User, fn, *args):
+   def write():
+      with pool.writer() as con:
+         return fn(con, *args)
+   return await run_blocking(user.session_token, write)
+
+#empty response that triggers a trend-window event in the page with the new window of the session
+#the page then asks /series for each open trend and updates the traces in place, no plot is rebuilt on the server
+def trend_window_response(user: User) -> Response:
+   start_time, end_time = get_window(user)
+   trigger = {"trend-window": {"start": to_epoch_us(start_time), "end": to_epoch_us(end_time)}}
+   return Response(status_code=204, headers={"HX-Trigger": json.dumps(trigger)})
+
+#checks data.csv for new rows with the writer connection, the schema, migration and backfill steps only run at startup
+def poll_new_data() -> None:
+   with pool.writer() as con:
+      poll_data(con)
+
+#checks data.csv for new rows every LIVE_POLL_SECONDS, one poll for the whole process however many sessions are live
+#the rows are pushed to the live streams by the ingest itself, so no session polls the database
+async def poll_ingest() -> None:
+   while True:
+      await asyncio.sleep(LIVE_POLL_SECONDS)
+      try:
+         await asyncio.get_running_loop().run_in_executor(None, poll_new_data)
+      except Exception as e:
+         print(f"Unable to poll for new data: {e}")
+
+#ingest data once at startup in the background, the server can accept requests while it runs
+#afterwards keep ingesting new rows as they are appended to the file
+@app.on_event("startup")
+async def startup() -> None:
+   loop = asyncio.get_running_loop()
+   hub.start(loop)
+   loop.run_in_executor(None, ingest_data)
+   app.state.poller = asyncio.create_task(poll_ingest())
+
 #initializes database and global variables
 @app.get("/")
 async def initialize(request: Request, session_token: str = Cookie(None)) -> HTMLResponse:
@@ -40,7 +113,10 @@ async def initialize(request: Request, session_token: str = Cookie(None)) -> HTM
    else:
       user = user_sessions[session_token]   
 
-   response = templates.TemplateResponse(request, "index.html", {"text": ""})
+   #a returning session gets its open plots back with the page
+   plot_html = await generate_plots(user)
+
+   response = templates.TemplateResponse(request, "index.html", {"text": "", "plotly_js": "/" + PLOTLY_JS, "plots": plot_html})
 
    #set the cookies in the users browser
    response.set_cookie(
@@ -50,10 +126,6 @@ async def initialize(request: Request, session_token: str = Cookie(None)) -> HTM
       httponly = True,
    )
 
-   #initialize database and populate with the data from the csv
-   initialize_db(con_data)
-
-   
    return response
 
 #renders the formula documentation page
@@ -84,21 +156,21 @@ async def get_tag_id(tag_id: str = Form(), session_token: str = Cookie(None)) ->
 
       #check for repeat plots
       existing_tag_ids = [tag.id for tag in user.current_plots]
+      new_tags = []
       if tag.id in existing_tag_ids:
          print(f"Plot already exists for tag {tag.id}")
       
       else:
          #if try block runs, add plot count to html response
          user.current_plots.append(tag)
+         new_tags.append(tag)
 
       try:
-         #call plot data to collect tag data for queried tag and all other currently plotted tags
-         plot_html = generate_plots(con_data, user)
+         #only the queried tag is plotted, the page appends it after the plots that are already open
+         plot_html = await generate_plots(user, new_tags)
          tag_id = tag.id
          return HTMLResponse(f"""
-                        <div id="plot-area" hx-swap-oob="true"">
-                           {plot_html}
-                        </div>
+                        {plot_html}
                         <div id="current-tags-list" hx-swap-oob="true">
                            <ul>
                               {''.join(f'<button type="button" id="{tag.id}" name="tag_id" value="{tag.id}" hx-post="/insert-tag-into-formula" hx-include="#formula-input">{tag.id}</button>' for tag in user.current_plots)}
@@ -131,13 +203,8 @@ async def update_time_frame(time_frame: str = Form(), session_token: str = Cooki
          update_preferences(cleaned_time_frame, user)
 
          try:
-            #call plot data to collect tag data for all currently plotted tags
-            plot_html = generate_plots(con_data, user)
-            return HTMLResponse(f"""
-                           <div id="plot-area" hx-swap-oob="true"">
-                              {plot_html}
-                           </div>
-                           """)
+            #only the window changed, the page refreshes the data of every open trend in place through /series
+            return trend_window_response(user)
       
          except Exception as e:
             return HTMLResponse(f"""
@@ -151,6 +218,32 @@ async def update_time_frame(time_frame: str = Form(), session_token: str = Cooki
    else:
       print("please enter a time frame")
 
+#updates the number of points per trace and the downsampling method for the current session
+#method "exact" turns downsampling off so zoomed in views show every sample
+@app.post("/update-resolution")
+async def update_plot_resolution(max_points: int = Form(default=MAX_POINTS), method: str = Form(default="minmax"), session_token: str = Cookie(None)) -> HTMLResponse:
+   
+   #check cookie
+   if check_cookie(session_token, user_sessions):
+      user = user_sessions[session_token]
+   else:
+      return HTMLResponse(f"Session not found")
+   
+   if method not in METHODS or max_points < 2:
+      return HTMLResponse(f"Invalid resolution, choose one of {', '.join(METHODS)} with at least 2 points.")
+
+   update_resolution(max_points, method, user)
+
+   try:
+      #only the window changed, the page refreshes the data of every open trend in place through /series
+      return trend_window_response(user)
+      
+   except Exception as e:
+      return HTMLResponse(f"""
+                           <h1>Error updating resolution</h1>
+                           <p>{e}</p>
+                           """)
+
 #moves the anchor time as far baack as possible given the current time frame
 @app.post("/go-past")
 async def go_past(session_token: str = Cookie(None)) -> HTMLResponse:
@@ -161,15 +254,10 @@ async def go_past(session_token: str = Cookie(None)) -> HTMLResponse:
    else:
       return HTMLResponse(f"Session not found")
    
-   update_anchor_time(con_data, user, "go_past")
+   update_anchor_time(user, "go_past")
    try:
-      #call plot data to collect tag data for all currently plotted tags
-      plot_html = generate_plots(con_data, user)
-      return HTMLResponse(f"""
-                           <div id="plot-area" hx-swap-oob="true"">
-                              {plot_html}
-                           </div>
-                           """)
+      #only the window changed, the page refreshes the data of every open trend in place through /series
+      return trend_window_response(user)
       
    except Exception as e:
       return HTMLResponse(f"""
@@ -187,15 +275,10 @@ async def go_back(session_token: str = Cookie(None)) -> HTMLResponse:
    else:
       return HTMLResponse(f"Session not found")
    
-   update_anchor_time(con_data, user, "go_back")
+   update_anchor_time(user, "go_back")
    try:
-      #call plot data to collect tag data for all currently plotted tags
-      plot_html = generate_plots(con_data, user)
-      return HTMLResponse(f"""
-                           <div id="plot-area" hx-swap-oob="true"">
-                              {plot_html}
-                           </div>
-                           """)
+      #only the window changed, the page refreshes the data of every open trend in place through /series
+      return trend_window_response(user)
       
    except Exception as e:
       return HTMLResponse(f"""
@@ -213,15 +296,10 @@ async def go_back(session_token: str = Cookie(None)) -> HTMLResponse:
    else:
       return HTMLResponse(f"Session not found")
    
-   update_anchor_time(con_data, user, "go_forward")
+   update_anchor_time(user, "go_forward")
    try:
-      #call plot data to collect tag data for all currently plotted tags
-      plot_html = generate_plots(con_data, user)
-      return HTMLResponse(f"""
-                           <div id="plot-area" hx-swap-oob="true"">
-                              {plot_html}
-                           </div>
-                           """)
+      #only the window changed, the page refreshes the data of every open trend in place through /series
+      return trend_window_response(user)
       
    except Exception as e:
       return HTMLResponse(f"""
@@ -239,15 +317,10 @@ async def go_past(session_token: str = Cookie(None)) -> HTMLResponse:
    else:
       return HTMLResponse(f"Session not found")
    
-   update_anchor_time(con_data, user, "go_present")
+   update_anchor_time(user, "go_present")
    try:
-      #call plot data to collect tag data for all currently plotted tags
-      plot_html = generate_plots(con_data, user)
-      return HTMLResponse(f"""
-                           <div id="plot-area" hx-swap-oob="true"">
-                              {plot_html}
-                           </div>
-                           """)
+      #only the window changed, the page refreshes the data of every open trend in place through /series
+      return trend_window_response(user)
       
    except Exception as e:
       return HTMLResponse(f"""
@@ -255,6 +328,154 @@ async def go_past(session_token: str = Cookie(None)) -> HTMLResponse:
                            <p>{e}</p>
                            """)
 
+#returns the samples of one tag in a window as compact typed arrays for client side trace updates
+#start and end are epoch microseconds and default to the window of the session
+#x holds epoch milliseconds and y the values, both base64 encoded little-endian float64
+@app.get("/series")
+async def series(tag: str, start: int | None = None, end: int | None = None, max_points: int | None = None, method: str | None = None, session_token: str = Cookie(None)) -> JSONResponse:
+   
+   #check cookie
+   if check_cookie(session_token, user_sessions):
+      user = user_sessions[session_token]
+   else:
+      return JSONResponse({"error": "Session not found"}, status_code=401)
+
+   if not re.match(r'^[a-zA-Z0-9_ ]+$', tag):
+      return JSONResponse({"error": "Invalid tag ID format."}, status_code=400)
+
+   #fall back to the window and resolution of the session for anything not given
+   start_time, end_time = get_window(user)
+   if start is not None:
+      start_time = from_epoch_us(start)
+   if end is not None:
+      end_time = from_epoch_us(end)
+   max_points = max_points or user.max_points
+   method = method or user.downsample
+
+   if method not in METHODS or max_points < 2:
+      return JSONResponse({"error": f"Invalid resolution, choose one of {', '.join(METHODS)} with at least 2 points."}, status_code=400)
+
+   try:
+      ts, values = await run_db(user, get_plot_series, tag, start_time, end_time, max_points, method)
+      return JSONResponse({
+         "tag": tag,
+         "start": to_epoch_us(start_time),
+         "end": to_epoch_us(end_time),
+         "length": len(ts),
+         "x": encode_float64(ts / 1000),
+         "y": encode_float64(values),
+      })
+
+   except Exception as e:
+      return JSONResponse({"error": f"Unable to read series for tag {tag}: {e}"}, status_code=500)
+
+#html of the progress of an upload, rows per second is the ingest throughput
+def upload_progress_html(progress: UploadProgress) -> str:
+   if progress.error:
+      status = f"Upload failed after {progress.rows:,} rows: {progress.error}"
+   elif progress.finished:
+      status = f"Uploaded {progress.rows:,} rows in {progress.seconds:.1f} s ({progress.rows_per_second:,.0f} rows/s)"
+   else:
+      total = f" of {progress.total_bytes / 1e6:,.1f}" if progress.total_bytes else ""
+      status = f"Uploading... {progress.bytes / 1e6:,.1f}{total} MB, {progress.rows:,} rows ({progress.rows_per_second:,.0f} rows/s)"
+   return f'<div id="upload-progress"><p>{status}</p></div>'
+
+#ingests a csv file sent as the raw request body (Time column + one column per tag)
+#the body is parsed while it streams in and every batch of rows is written in its own transaction,
+#so memory stays the same however large the file is and a reader never waits on one huge transaction
+@app.post("/upload-csv")
+async def upload_csv(request: Request, session_token: str = Cookie(None)) -> HTMLResponse:
+
+   #check cookie
+   if check_cookie(session_token, user_sessions):
+      user = user_sessions[session_token]
+   else:
+      return HTMLResponse(f"Session not found")
+
+   progress = uploads[session_token] = UploadProgress(int(request.headers.get("content-length") or 0))
+   chunker = CsvChunker()
+
+   try:
+      #the next bytes are only read once the previous batch is written, a slow disk slows the upload instead of filling memory
+      async for data in request.stream():
+         progress.bytes += len(data)
+         for df in chunker.feed(data):
+            progress.rows += await run_write(user, append_frame, df)
+
+      for df in chunker.close():
+         progress.rows += await run_write(user, append_frame, df)
+
+      #old samples of the upload are packed and archived like the ones ingested from data.csv
+      await run_write(user, settle_samples)
+
+   except Exception as e:
+      print(f"Unable to ingest upload: {e}")
+      progress.error = str(e)
+
+   progress.finished = time.perf_counter()
+   return HTMLResponse(upload_progress_html(progress))
+
+#reports how far the latest upload of the session got, polled by the page while it uploads
+@app.get("/upload-progress")
+async def upload_progress(session_token: str = Cookie(None)) -> HTMLResponse:
+
+   #check cookie
+   if check_cookie(session_token, user_sessions):
+      progress = uploads.get(session_token)
+   else:
+      return HTMLResponse(f"Session not found")
+
+   if progress is None:
+      return HTMLResponse('<div id="upload-progress"></div>')
+   return HTMLResponse(upload_progress_html(progress))
+
+#server-sent events with the samples ingested for the plotted tags of the session, sent as they arrive
+#every event carries {tag: {x, y}} with x in epoch milliseconds and y the values, both base64 float64 like /series
+#the window of the session follows the newest sample so navigation continues from what the live trend shows
+@app.get("/live")
+async def live(request: Request, session_token: str = Cookie(None)) -> StreamingResponse:
+
+   #check cookie
+   if check_cookie(session_token, user_sessions):
+      user = user_sessions[session_token]
+   else:
+      return JSONResponse({"error": "Session not found"}, status_code=401)
+
+   async def events():
+      queue = hub.subscribe()
+      try:
+         while not await request.is_disconnected():
+            try:
+               batch = await asyncio.wait_for(queue.get(), timeout=15)
+            except asyncio.TimeoutError:
+               #a comment line keeps proxies from closing an idle stream
+               yield ": keep-alive\n\n"
+               continue
+
+            plotted = {tag.id for tag in user.current_plots}
+            samples = {tag: (ts, values) for tag, (ts, values) in batch.items() if tag in plotted and len(ts)}
+            if not samples:
+               continue
+
+            user.anchor_time = from_epoch_us(max(int(ts[-1]) for ts, _ in samples.values()))
+
+            data = {tag: {"x": encode_float64(ts / 1000), "y": encode_float64(values)} for tag, (ts, values) in samples.items()}
+            yield f"event: samples\ndata: {json.dumps(data)}\n\n"
+      finally:
+         hub.unsubscribe(queue)
+
+   return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+#lists every tag with its kind, time range, sample count and value range from the in memory catalog
+@app.get("/tags")
+async def list_tags(session_token: str = Cookie(None)) -> JSONResponse:
+
+   #check cookie
+   if not check_cookie(session_token, user_sessions):
+      return JSONResponse({"error": "Session not found"}, status_code=401)
+
+   return JSONResponse({"tags": [info.to_dict() for info in catalog.all()]})
+
 #insert tag into formula
 @app.post("/insert-tag-into-formula")
 async def insert_tag_into_formula(tag_id: str = Form(), formula: str = Form(default=""), session_token: str = Cookie(None)) -> HTMLResponse:
@@ -268,9 +489,10 @@ async def insert_tag_into_formula(tag_id: str = Form(), formula: str = Form(defa
    new_formula = formula + tag_id
    return HTMLResponse(f"""
                            <div id="formula-input-container" hx-swap-oob="true">
-                              <form id="formula-form" hx-post='/execute-formula' hx-trigger="submit" hx-target="#plot-area">
+                              <form id="formula-form" hx-post='/execute-formula' hx-trigger="submit" hx-target="#plot-area" hx-swap="beforeend">
                                  <input id="formula-input" type="text" name="formula" class="input" placeholder="Enter formula" value="{new_formula}">
                                  <input id="new-tag-input" type="text" name="new_tag_id" class="input" placeholder="Enter new tag ID:">
+                                 <label><input type="checkbox" name="materialize" value="true"> Materialize</label>
                                  <input type="submit" name="execute_formula" class="button" value="Execute">
                               </form>
                            </div>
@@ -284,7 +506,7 @@ async def insert_tag_into_formula(tag_id: str = Form(), formula: str = Form(defa
 
 #execute formula by pasing and running appropriate operations functions
 @app.post("/execute-formula")
-async def execute_formula(formula: str = Form(), new_tag_id: str = Form(), session_token: str = Cookie(None)) -> HTMLResponse:
+async def execute_formula(formula: str = Form(), new_tag_id: str = Form(), materialize: bool = Form(default=False), session_token: str = Cookie(None)) -> HTMLResponse:
    
    #check cookie
    if check_cookie(session_token, user_sessions):
@@ -299,40 +521,34 @@ async def execute_formula(formula: str = Form(), new_tag_id: str = Form(), sessi
                               <p>Please enter a new tag ID</p>
                            </div>
                            """)
-   #parse the formula entered by the user, perform the operations, and insert the new tag into the database
+   #store the formula as a new tag, it is evaluated for the window being plotted unless the user asks to materialize it
    else:
       try: 
-         #returns df object with operations performed
-         result = parse_formula(formula)
-
-         #rename the column to the new tag ID if the result is a dataframe, if the result is a const, no operation is necessary
-         if isinstance(result, pd.DataFrame):
-            result = result.rename(columns={result.columns[1]: new_tag_id})
-
          #validate new tag ID to prevent SQL injection
-         #only allow alphanumeric characters, underscores, and spaces (SQLite identifiers)
-         #spaces allowed for user-created formulas
-         if not re.match(r'^[a-zA-Z0-9_ ]+$', new_tag_id):
-            return HTMLResponse(f"Invalid tag ID format.")
+         #the new tag has to be a tag ID the formula grammar accepts so other formulas can reference it
+         #(letters, digits and underscores starting with a letter, uppercased like the tags queried with get-tag-id)
+         new_tag_id = new_tag_id.upper()
+         if not is_tag_id(new_tag_id):
+            return HTMLResponse(f"Invalid tag ID format. Use letters, digits and underscores, starting with a letter.")
 
          else:
-            tag = Tag(str(new_tag_id), result, Tag.get_color())
+            tag = Tag(str(new_tag_id), None, Tag.get_color())
 
-            #insert the new tag into the database, creates a tag object as well
-            insert_new_tag(con_data, tag)
+            #insert the new tag into the tag catalog, raises if the formula is invalid
+            await run_write(user, create_formula_tag, tag, formula, materialize)
 
             #new tag id is succesfully inserted into the database, add to current plots and plot count
             existing_tag_ids = [tag.id for tag in user.current_plots]
+            new_tags = []
             if tag.id not in existing_tag_ids:
                user.current_plots.append(tag)
+               new_tags.append(tag)
 
-            #replot all data with new tag
+            #plot only the new tag, the page appends it after the plots that are already open
             try:
-               plot_html = generate_plots(con_data, user)
+               plot_html = await generate_plots(user, new_tags)
                return HTMLResponse(f"""
-                                 <div id="plot-area" hx-swap-oob="true"">
-                                    {plot_html}
-                                 </div>
+                                 {plot_html}
                                  <div id="current-tags-list" hx-swap-oob="true">
                                     <ul>
                                        {''.join(f'<button type="button" id="{tag.id}" name="tag_id" value="{tag.id}" hx-post="/insert-tag-into-formula" hx-include="#formula-input">{tag.id}</button>' for tag in user.current_plots)}
@@ -0,0 +1,153 @@
+from sqlite3 import Connection
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+#directory of the archive tier, one sub directory per tag key
+ARCHIVE_DIR = "archive"
+
+#width of one archive partition in microseconds, partitions start at multiples of it
+ARCHIVE_PARTITION = 28 * 24 * 60 * 60 * 1000000
+
+#samples older than this many microseconds before the newest sample move from sqlite into the archive
+ARCHIVE_AFTER = 90 * 24 * 60 * 60 * 1000000
+
+#partitions kept memory mapped per process, each one holds two maps, well below the vm.max_map_count default of 65530
+ARCHIVE_MAPS = 1024
+
+#cold history as per tag, time partitioned pairs of .npy files (int64 epoch microseconds and float64 values)
+#the files are memory mapped, so a window read is a zero-copy slice of contiguous buffers instead of sql rows
+#archive_partitions in sqlite is the index of which partitions exist and what time range they hold
+#every rewrite of a partition bumps its generation, so a process holding a map of the old files (e.g. another uvicorn
+#worker rewrote the partition) opens the new ones on its next read
+class Archive:
+    def __init__(self, directory: str = ARCHIVE_DIR, max_maps: int = ARCHIVE_MAPS):
+        self.directory = directory
+        self.max_maps = max_maps
+        self.lock = threading.Lock()
+
+        #open memory maps by (tag key, partition start) -> (generation, arrays), least recently used first
+        self.maps = OrderedDict()
+
+    def create_table(self, con: Connection) -> None:
+        con.execute("""CREATE TABLE IF NOT EXISTS archive_partitions (
+                            tag_id INTEGER NOT NULL,
+                            start INTEGER NOT NULL,
+                            first_ts INTEGER NOT NULL,
+                            last_ts INTEGER NOT NULL,
+                            count INTEGER NOT NULL,
+                            generation INTEGER NOT NULL DEFAULT 0,
+                            PRIMARY KEY (tag_id, start)
+                        ) WITHOUT ROWID""")
+
+        #archives created before partitions had a generation get the column added
+        columns = [row[1] for row in con.execute("PRAGMA table_info(archive_partitions)")]
+        if "generation" not in columns:
+            con.execute("ALTER TABLE archive_partitions ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+
+    def paths(self, key: int, start: int) -> tuple[str, str]:
+        base = os.path.join(self.directory, str(key), str(start))
+        return base + ".ts.npy", base + ".values.npy"
+
+    #returns the memory mapped (ts, values) of a partition at the given generation
+    #a map of another generation is of files that were replaced since, it is dropped and the files are opened again
+    #slices handed out earlier keep their map alive until they are released
+    def load(self, key: int, start: int, generation: int) -> tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            entry = self.maps.get((key, start))
+            if entry is not None and entry[0] == generation:
+                self.maps.move_to_end((key, start))
+                return entry[1]
+
+            ts_path, values_path = self.paths(key, start)
+            arrays = (np.asarray(np.load(ts_path, mmap_mode="r")), np.asarray(np.load(values_path, mmap_mode="r")))
+            self.maps[(key, start)] = (generation, arrays)
+            self.maps.move_to_end((key, start))
+            while len(self.maps) > self.max_maps:
+                self.maps.popitem(last=False)
+            return arrays
+
+    #returns the archived samples of a tag key with start_ts <= ts < end_ts, one (ts, values) slice per partition in time order
+    #the slices are views of the memory mapped files, nothing is copied
+    def read(self, con: Connection, key: int, start_ts: int, end_ts: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        rows = con.execute("""SELECT start, generation FROM archive_partitions
+                            WHERE tag_id = ? AND last_ts >= ? AND first_ts < ?
+                            ORDER BY start""", (key, int(start_ts), int(end_ts))).fetchall()
+
+        parts = []
+        for start, generation in rows:
+            ts, values = self.load(key, start, generation)
+            a, b = np.searchsorted(ts, [start_ts, end_ts])
+            if b > a:
+                parts.append((ts[a:b], values[a:b]))
+        return parts
+
+    #returns the last archived sample of a tag key before ts, or the first one after ts with after set, None without one
+    def neighbour(self, con: Connection, key: int, ts: int, after: bool = False) -> tuple[int, float] | None:
+        if after:
+            row = con.execute("""SELECT start, generation FROM archive_partitions WHERE tag_id = ? AND last_ts > ?
+                                ORDER BY start LIMIT 1""", (key, int(ts))).fetchone()
+        else:
+            row = con.execute("""SELECT start, generation FROM archive_partitions WHERE tag_id = ? AND first_ts < ?
+                                ORDER BY start DESC LIMIT 1""", (key, int(ts))).fetchone()
+        if row is None:
+            return None
+
+        part_ts, values = self.load(key, *row)
+        i = np.searchsorted(part_ts, ts, side="right") if after else np.searchsorted(part_ts, ts) - 1
+        return int(part_ts[i]), float(values[i])
+
+    #writes the samples of one partition, merged with what the partition already holds (new samples win)
+    #the files are replaced atomically, readers holding the old memory map keep reading the old files
+    def write(self, con: Connection, key: int, start: int, ts: np.ndarray, values: np.ndarray) -> None:
+        row = con.execute("SELECT generation FROM archive_partitions WHERE tag_id = ? AND start = ?", (key, start)).fetchone()
+        generation = 0
+        if row is not None:
+            old_ts, old_values = self.load(key, start, row[0])
+            ts, values = merge([(old_ts, old_values), (ts, values)])
+            generation = row[0] + 1
+
+        os.makedirs(os.path.join(self.directory, str(key)), exist_ok=True)
+        for path, array in zip(self.paths(key, start), (ts, values)):
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, np.ascontiguousarray(array))
+            os.replace(path + ".tmp", path)
+
+        with self.lock:
+            self.maps.pop((key, start), None)
+
+        con.execute("""INSERT OR REPLACE INTO archive_partitions (tag_id, start, first_ts, last_ts, count, generation)
+                        VALUES (?, ?, ?, ?, ?, ?)""", (key, start, int(ts[0]), int(ts[-1]), len(ts), generation))
+
+    #returns the first and last archived timestamp of a tag key, or of every tag without a key
+    def bounds(self, con: Connection, key: int | None = None) -> tuple[int | None, int | None]:
+        if key is None:
+            return con.execute("SELECT MIN(first_ts), MAX(last_ts) FROM archive_partitions").fetchone()
+        return con.execute("SELECT MIN(first_ts), MAX(last_ts) FROM archive_partitions WHERE tag_id = ?", (key,)).fetchone()
+
+#joins sorted (ts, values) parts into one series, a single part is returned as is without copying
+#parts that overlap in time are merged, on equal timestamps the later part wins
+def merge(parts: list[tuple[np.ndarray, np.ndarray]]) -> tuple[np.ndarray, np.ndarray]:
+    parts = [part for part in parts if len(part[0])]
+    if not parts:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    if len(parts) == 1:
+        return parts[0]
+
+    ts = np.concatenate([part[0] for part in parts])
+    values = np.concatenate([part[1] for part in parts])
+
+    #parts in time order without overlap just need the concatenation
+    if all(a[0][-1] < b[0][0] for a, b in zip(parts, parts[1:])):
+        return ts, values
+
+    #stable sort keeps later parts after earlier ones on equal timestamps, then keep the last of every timestamp
+    order = np.argsort(ts, kind="stable")
+    ts, values = ts[order], values[order]
+    last = np.r_[ts[1:] != ts[:-1], True]
+    return ts[last], values[last]
+
+#shared by the whole process
+archive = Archive()
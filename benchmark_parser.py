@@ -0,0 +1,50 @@
+from time import perf_counter
+import random
+
+from lark import Lark
+
+from parser import grammar, parser, parse_tree
+
+#builds a formula with the given number of operands, e.g. TI001 * 2.5 + (PI001 - TI001) / 3
+def generate_formula(operands: int) -> str:
+    tags = ["TI001", "PI001", "FI001", "LI001"]
+    operators = ["+", "-", "*", "/"]
+    parts = []
+
+    for i in range(operands):
+        operand = random.choice(tags) if i % 2 == 0 else str(round(random.uniform(1, 100), 2))
+        if i % 5 == 4:
+            operand = f"({operand} - {random.choice(tags)})"
+        parts.append(operand)
+        if i < operands - 1:
+            parts.append(random.choice(operators))
+
+    return " ".join(parts)
+
+#returns the average seconds per call of fn(formula)
+def time_parse(fn, formula: str, repeats: int) -> float:
+    start = perf_counter()
+    for _ in range(repeats):
+        fn(formula)
+    return (perf_counter() - start) / repeats
+
+#compares the old Earley parser, the LALR parser and the cached parse for growing formula sizes
+def benchmark_parser(sizes: list[int], repeats: int = 20) -> None:
+    random.seed(0)
+    earley = Lark(grammar, start='start')
+
+    print(f"{'operands':>8} {'chars':>6} {'earley (us)':>12} {'lalr (us)':>10} {'cached (us)':>12} {'speedup':>8}")
+    for size in sizes:
+        formula = generate_formula(size)
+
+        earley_time = time_parse(earley.parse, formula, repeats)
+        lalr_time = time_parse(parser.parse, formula, repeats)
+
+        #first call fills the parse cache, the timed calls are all hits
+        parse_tree(formula)
+        cached_time = time_parse(parse_tree, formula, repeats)
+
+        print(f"{size:>8} {len(formula):>6} {earley_time * 1e6:>12.1f} {lalr_time * 1e6:>10.1f} {cached_time * 1e6:>12.2f} {earley_time / lalr_time:>7.1f}x")
+
+
+benchmark_parser([1, 5, 10, 25, 50, 100, 250])
@@ -0,0 +1,108 @@
+from collections import OrderedDict
+from typing import Callable
+import threading
+
+import numpy as np
+
+#default memory budget of the shared series cache in bytes
+CACHE_BYTES = 256 * 1024 * 1024
+
+#process wide cache of (tag, start_ts, end_ts, resolution...) -> arrays with least recently used eviction
+#every key starts with the tag id and the window as epoch microseconds so ingestion can invalidate by tag and time
+#concurrent requests for the same missing key share one load instead of each running the same query
+#entries also remember the version of the tag they were read at, the version is kept in the database so writes from
+#other processes (another uvicorn worker) make the entry stale as well
+class WindowCache:
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+        #keys being loaded right now, other requests for the key wait on the event
+        self.loading = {}
+
+        #bumped every time a tag is invalidated, a load that started before the bump is not stored
+        self.generations = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    #returns the cached arrays for key, calling load() to read them on a miss
+    #an entry read at another version of the tag counts as a miss and is replaced
+    def get(self, key: tuple, load: Callable[[], tuple[np.ndarray, ...]], version: int | None = None) -> tuple[np.ndarray, ...]:
+        tag = key[0]
+
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    entry_version, arrays = self.entries[key]
+                    if entry_version == version:
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        return arrays
+                    self.remove(key)
+
+                event = self.loading.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self.loading[key] = event
+                    generation = self.generations.get(tag, 0)
+                    self.misses += 1
+                    break
+
+            #another request is loading the same key, wait for it and look again
+            event.wait()
+
+        try:
+            arrays = tuple(load())
+
+            #cached arrays are shared between sessions, so make sure nobody modifies them in place
+            for array in arrays:
+                array.flags.writeable = False
+
+            with self.lock:
+                if self.generations.get(tag, 0) == generation:
+                    self.store(key, arrays, version)
+            return arrays
+
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    #adds an entry and evicts the least recently used entries until the cache fits its budget again
+    #must be called with the lock held
+    def store(self, key: tuple, arrays: tuple[np.ndarray, ...], version: int | None = None) -> None:
+        size = sum(array.nbytes for array in arrays)
+        if size > self.max_bytes:
+            return
+
+        self.entries[key] = (version, arrays)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    #drops one entry, must be called with the lock held
+    def remove(self, key: tuple) -> None:
+        _, arrays = self.entries.pop(key)
+        self.nbytes -= sum(array.nbytes for array in arrays)
+
+    #drops the entries of a tag whose window ends at or after start_ts, i.e. every window new samples can land in
+    #without start_ts every entry of the tag is dropped
+    def invalidate(self, tag: str, start_ts: int | None = None) -> None:
+        with self.lock:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+
+            stale = [key for key in self.entries if key[0] == tag and (start_ts is None or key[2] >= start_ts)]
+            for key in stale:
+                self.remove(key)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.generations.clear()
+
+#shared by every session of the process
+series_cache = WindowCache()
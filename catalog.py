@@ -0,0 +1,70 @@
+from datetime import datetime
+import threading
+
+from utility import from_epoch_us
+
+#what the catalog knows about one tag, the sample stats are None for tags without samples (constants, lazy formulas)
+#first and last are epoch microseconds
+class TagInfo:
+    def __init__(self, name: str, kind: str, first: int | None = None, last: int | None = None,
+                 count: int = 0, minimum: float | None = None, maximum: float | None = None):
+        self.name = name
+        self.kind = kind
+        self.first = first
+        self.last = last
+        self.count = count
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "first": from_epoch_us(self.first).isoformat() if self.first is not None else None,
+            "last": from_epoch_us(self.last).isoformat() if self.last is not None else None,
+            "count": self.count,
+            "min": self.minimum,
+            "max": self.maximum,
+        }
+
+#process wide, in memory copy of the tag catalog with per tag time range, sample count and value range
+#ingestion keeps it up to date, so navigation and tag listings never scan the samples
+class TagCatalog:
+    def __init__(self):
+        self.tags = {}
+        self.lock = threading.Lock()
+
+        #first and last timestamp over every tag, recomputed whenever a tag changes so reading them is O(1)
+        self.first = None
+        self.last = None
+
+        #sqlite data_version of the connection the whole catalog was last loaded with, it changes when another process writes
+        self.data_version = None
+
+    #replaces the entries of the given tags, with replace_all the given tags become the whole catalog
+    def update(self, infos: list[TagInfo], replace_all: bool = False) -> None:
+        with self.lock:
+            if replace_all:
+                self.tags = {}
+            for info in infos:
+                self.tags[info.name] = info
+
+            firsts = [info.first for info in self.tags.values() if info.first is not None]
+            lasts = [info.last for info in self.tags.values() if info.last is not None]
+            self.first = min(firsts) if firsts else None
+            self.last = max(lasts) if lasts else None
+
+    def get(self, name: str) -> TagInfo | None:
+        return self.tags.get(name)
+
+    def all(self) -> list[TagInfo]:
+        with self.lock:
+            return sorted(self.tags.values(), key=lambda info: info.name)
+
+    #returns the (first, last) time of the whole dataset as datetimes, None when nothing is loaded yet
+    def bounds(self) -> tuple[datetime | None, datetime | None]:
+        first, last = self.first, self.last
+        return (from_epoch_us(first) if first is not None else None), (from_epoch_us(last) if last is not None else None)
+
+#shared by the whole process
+catalog = TagCatalog()
@@ -0,0 +1,48 @@
+import zlib
+
+import numpy as np
+
+#zlib level of the sample blocks, the encodings leave mostly zero bytes so the fastest level already compresses well
+COMPRESSION_LEVEL = 1
+
+#smallest signed integer type that holds every value of the array
+def narrowest(values: np.ndarray) -> np.dtype:
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if not len(values) or (values.min() >= info.min and values.max() <= info.max):
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+#timestamps as delta-of-delta, a fixed cadence turns into zeros and jitter into small numbers
+#the first timestamp and the first delta are kept as the first two entries, the rest are stored in the narrowest integer type
+def encode_timestamps(ts: np.ndarray) -> bytes:
+    ts = np.asarray(ts, dtype=np.int64)
+    dod = np.diff(ts, n=2, prepend=[0, 0]) if len(ts) else ts
+    head, rest = dod[:2], dod[2:]
+    dtype = narrowest(rest)
+    return bytes([dtype.itemsize]) + head.astype("<i8").tobytes() + zlib.compress(rest.astype(dtype.newbyteorder("<")).tobytes(), COMPRESSION_LEVEL)
+
+#inverse of encode_timestamps, two cumulative sums rebuild the deltas and then the timestamps
+def decode_timestamps(data: bytes, count: int) -> np.ndarray:
+    itemsize = data[0]
+    head_length = min(count, 2) * 8
+    head = np.frombuffer(data, dtype="<i8", count=min(count, 2), offset=1)
+    rest = np.frombuffer(zlib.decompress(data[1 + head_length:]), dtype=np.dtype(f"<i{itemsize}"))
+    dod = np.concatenate([head, rest.astype(np.int64)])
+    return np.cumsum(np.cumsum(dod))
+
+#values xor'ed with the previous value (gorilla style), slowly drifting values share sign, exponent and top mantissa bits
+#so the xors are mostly zero bytes, storing byte 0 of every value, then byte 1 and so on groups the zeros for zlib
+def encode_values(values: np.ndarray) -> bytes:
+    bits = np.ascontiguousarray(values, dtype="<f8").view("<u8")
+    previous = np.zeros_like(bits)
+    previous[1:] = bits[:-1]
+    xor = np.bitwise_xor(bits, previous)
+    shuffled = xor.view(np.uint8).reshape(-1, 8).T
+    return zlib.compress(np.ascontiguousarray(shuffled).tobytes(), COMPRESSION_LEVEL)
+
+#inverse of encode_values, a cumulative xor undoes the xor with the previous value
+def decode_values(data: bytes, count: int) -> np.ndarray:
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(8, count)
+    xor = np.ascontiguousarray(shuffled.T).view("<u8").ravel()
+    return np.bitwise_xor.accumulate(xor).view("<f8").astype(np.float64)
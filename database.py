@@ -3,26 +3,620 @@ import pandas as pd
 import numpy as np
 from fastapi.responses import HTMLResponse
 from datetime import datetime, timedelta
-import re
+import asyncio
+from itertools import repeat
+from typing import Iterable, Iterator
 from models import Tag, User
+from ingest import ingest_csv
+from utility import to_epoch_us, from_epoch_us
+from downsample import downsample
+from cache import series_cache
+from workers import run_blocking
+from pool import pool
+from parser import Carry, compile_formula, parse_formula, formula_tags
+from functions import CUMULATIVE
+from signals import DEFAULT_ALIGNMENT, Signal
+from dependencies import dependents, formula_graph
+from archive import ARCHIVE_AFTER, ARCHIVE_PARTITION, archive, merge
+from live import hub
+from catalog import TagInfo, catalog
+from compression import encode_timestamps, decode_timestamps, encode_values, decode_values
+
+#csv file used as the data source
+DATA_PATH = "data.csv"
+
+#pre-aggregated rollup tiers, (table name, bucket width in microseconds), finest first
+ROLLUP_TIERS = [
+    ("rollup_1m", 60 * 1000000),
+    ("rollup_1h", 60 * 60 * 1000000),
+    ("rollup_1d", 24 * 60 * 60 * 1000000),
+]
+
+#numpy dtypes of one row as it comes out of the samples and rollup tables
+SAMPLE_DTYPE = np.dtype([("ts", np.int64), ("value", np.float64)])
+KEYED_SAMPLE_DTYPE = np.dtype([("tag_id", np.int64), ("ts", np.int64), ("value", np.float64)])
+ROLLUP_DTYPE = np.dtype([("bucket", np.int64), ("min", np.float64), ("max", np.float64), ("mean", np.float64), ("first", np.float64), ("last", np.float64)])
+
+#rollups are rebuilt in slices of this many microseconds so a backfill never loads a whole history
+ROLLUP_SLICE = 7 * 24 * 60 * 60 * 1000000
+
+#samples older than COMPACT_AFTER before the newest sample are packed into compressed blocks of BLOCK_SAMPLES samples
+BLOCK_SAMPLES = 4096
+COMPACT_AFTER = 24 * 60 * 60 * 1000000
+
+#streamed formula evaluation produces the history in chunks of this many microseconds, aligned like the rollup slices
+#so every chunk rolls up whole days, the window read for a chunk reaches STREAM_OVERLAP further on both sides
+STREAM_CHUNK = ROLLUP_SLICE
+STREAM_OVERLAP = 60 * 60 * 1000000
+
+#a new formula tag is evaluated over this many microseconds at the end of the data before it is stored,
+#so a formula that fails on real samples is refused instead of failing on every read
+FORMULA_TRIAL = 60 * 60 * 1000000
+
+#creates the narrow storage tables
+#tags is the catalog mapping tag names to integer keys
+#samples keeps one (tag, time, value) row per sample, clustered on (tag_id, ts) so a time window read for one tag is an index range seek
+def create_schema(con: Connection) -> None:
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS tags (
+                            tag_id INTEGER PRIMARY KEY,
+                            name TEXT NOT NULL UNIQUE,
+                            constant REAL,
+                            formula TEXT,
+                            materialized INTEGER NOT NULL DEFAULT 0,
+                            version INTEGER NOT NULL DEFAULT 0
+                        )""")
+
+        #databases created before these catalog columns existed get them added
+        columns = [row[1] for row in con.execute("PRAGMA table_info(tags)")]
+        if "constant" not in columns:
+            con.execute("ALTER TABLE tags ADD COLUMN constant REAL")
+        if "formula" not in columns:
+            con.execute("ALTER TABLE tags ADD COLUMN formula TEXT")
+            con.execute("ALTER TABLE tags ADD COLUMN materialized INTEGER NOT NULL DEFAULT 0")
+        if "version" not in columns:
+            con.execute("ALTER TABLE tags ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        con.execute("""CREATE TABLE IF NOT EXISTS samples (
+                            tag_id INTEGER NOT NULL,
+                            ts INTEGER NOT NULL,
+                            value REAL,
+                            PRIMARY KEY (tag_id, ts)
+                        ) WITHOUT ROWID""")
+
+        #one row per tag and bucket with the stats of the samples in that bucket
+        for table, width in ROLLUP_TIERS:
+            con.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                                tag_id INTEGER NOT NULL,
+                                bucket INTEGER NOT NULL,
+                                count INTEGER NOT NULL,
+                                min REAL,
+                                max REAL,
+                                mean REAL,
+                                first REAL,
+                                last REAL,
+                                PRIMARY KEY (tag_id, bucket)
+                            ) WITHOUT ROWID""")
+
+        #compressed blocks of consecutive samples of one tag, keyed by their first timestamp, blocks never overlap
+        #samples of a block are no longer in samples, a late sample inside a block's range is kept in samples and wins on reads
+        con.execute("""CREATE TABLE IF NOT EXISTS sample_blocks (
+                            tag_id INTEGER NOT NULL,
+                            first_ts INTEGER NOT NULL,
+                            last_ts INTEGER NOT NULL,
+                            count INTEGER NOT NULL,
+                            ts_data BLOB NOT NULL,
+                            value_data BLOB NOT NULL,
+                            PRIMARY KEY (tag_id, first_ts)
+                        ) WITHOUT ROWID""")
+
+        #where the cumulative steps of a materialized formula tag stood at its last checkpoint, one row per step
+        #step is the step index, or the tag id of a cumulative lazy input, see Carry
+        con.execute("""CREATE TABLE IF NOT EXISTS formula_carry (
+                            tag_id INTEGER NOT NULL,
+                            step TEXT NOT NULL,
+                            ts INTEGER NOT NULL,
+                            value REAL,
+                            PRIMARY KEY (tag_id, step)
+                        ) WITHOUT ROWID""")
+
+        #index of the cold history moved out of samples into the archive tier
+        archive.create_table(con)
+
+#returns the integer key of a tag name, adds the tag to the catalog if create is set
+def get_tag_key(con: Connection, name: str, create: bool = False) -> int | None:
+    row = con.execute("SELECT tag_id FROM tags WHERE name = ?", (name,)).fetchone()
+    if row is not None:
+        return row[0]
+    if not create:
+        return None
+    return con.execute("INSERT INTO tags (name) VALUES (?)", (name,)).lastrowid
+
+#returns the version of a tag, bumped whenever its samples (or the inputs of a formula tag) change in any process
+#None for a tag that doesn't exist
+def get_tag_version(con: Connection, tag_id: str) -> int | None:
+    row = con.execute("SELECT version FROM tags WHERE name = ?", (tag_id,)).fetchone()
+    return row[0] if row is not None else None
+
+#returns the value of a constant tag, None if the tag is not a constant
+def get_constant(con: Connection, tag_id: str) -> float | None:
+    row = con.execute("SELECT constant FROM tags WHERE name = ?", (tag_id,)).fetchone()
+    return row[0] if row is not None else None
+
+#writes a computed series of a tag key in one bulk insert, NaN results are not stored
+#ts has to be int64 epoch microseconds, the rows go straight from the arrays into the narrow table
+def write_series(con: Connection, key: int, ts: np.ndarray, values: np.ndarray) -> None:
+    mask = ~np.isnan(values)
+    con.executemany("INSERT OR REPLACE INTO samples (tag_id, ts, value) VALUES (?, ?, ?)",
+                    zip(repeat(key), ts[mask].tolist(), values[mask].tolist()))
+
+#returns the samples of a tag key with start_ts <= ts < end_ts as typed arrays
+#archived, compressed and row samples come back as one series, a window inside one archive partition is a zero-copy view
+def read_samples(con: Connection, key: int, start_ts: int, end_ts: int) -> tuple[np.ndarray, np.ndarray]:
+    return merge(archive.read(con, key, start_ts, end_ts) + [read_sqlite_samples(con, key, start_ts, end_ts)])
+
+#reads the samples kept in sqlite, the compressed blocks and the rows written since the last compaction
+def read_sqlite_samples(con: Connection, key: int, start_ts: int, end_ts: int) -> tuple[np.ndarray, np.ndarray]:
+    return merge(read_blocks(con, key, start_ts, end_ts) + [read_hot_samples(con, key, start_ts, end_ts)])
+
+#decodes the blocks of a tag key that overlap start_ts <= ts < end_ts, one (ts, values) slice per block in time order
+def read_blocks(con: Connection, key: int, start_ts: int, end_ts: int) -> list[tuple[np.ndarray, np.ndarray]]:
+    cur = con.execute("""SELECT count, ts_data, value_data FROM sample_blocks
+                        WHERE tag_id = ? AND last_ts >= ? AND first_ts < ?
+                        ORDER BY first_ts""", (key, int(start_ts), int(end_ts)))
+
+    parts = []
+    for count, ts_data, value_data in cur:
+        ts = decode_timestamps(ts_data, count)
+        values = decode_values(value_data, count)
+        a, b = np.searchsorted(ts, [start_ts, end_ts])
+        parts.append((ts[a:b], values[a:b]))
+    return parts
+
+#stores consecutive samples of a tag key as one compressed block
+def write_block(con: Connection, key: int, ts: np.ndarray, values: np.ndarray) -> None:
+    con.execute("""INSERT OR REPLACE INTO sample_blocks (tag_id, first_ts, last_ts, count, ts_data, value_data)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                (key, int(ts[0]), int(ts[-1]), len(ts), encode_timestamps(ts), encode_values(values)))
+
+#removes the sqlite samples of a tag key with start_ts <= ts < end_ts, rows and blocks
+#a block that only partly overlaps the range is rewritten with the samples outside of it
+def delete_samples(con: Connection, key: int, start_ts: int, end_ts: int) -> None:
+    con.execute("DELETE FROM samples WHERE tag_id = ? AND ts >= ? AND ts < ?", (key, int(start_ts), int(end_ts)))
+
+    blocks = con.execute("""SELECT first_ts, count, ts_data, value_data FROM sample_blocks
+                            WHERE tag_id = ? AND last_ts >= ? AND first_ts < ?""", (key, int(start_ts), int(end_ts))).fetchall()
+    for first_ts, count, ts_data, value_data in blocks:
+        con.execute("DELETE FROM sample_blocks WHERE tag_id = ? AND first_ts = ?", (key, first_ts))
+
+        ts = decode_timestamps(ts_data, count)
+        keep = (ts < start_ts) | (ts >= end_ts)
+        if keep.any():
+            write_block(con, key, ts[keep], decode_values(value_data, count)[keep])
+
+#returns the last sample of a tag key before ts, or the first one after ts with after set, as arrays of at most one sample
+#raw samples are looked up in every storage tier, on equal timestamps the newer tier wins like in read_samples
+#with a rollup tier the neighbouring bucket mean is returned instead
+def neighbour_sample(con: Connection, key: int, ts: int, tier: tuple[str, int] | None = None, after: bool = False) -> tuple[np.ndarray, np.ndarray]:
+    comparison, order = (">", "") if after else ("<", "DESC")
+
+    if tier is not None:
+        candidates = [con.execute(f"""SELECT bucket, mean FROM {tier[0]} WHERE tag_id = ? AND bucket {comparison} ?
+                                    ORDER BY bucket {order} LIMIT 1""", (key, int(ts))).fetchone()]
+    else:
+        candidates = [archive.neighbour(con, key, ts, after)]
+
+        if after:
+            block = con.execute("""SELECT count, ts_data, value_data FROM sample_blocks WHERE tag_id = ? AND last_ts > ?
+                                ORDER BY first_ts LIMIT 1""", (key, int(ts))).fetchone()
+        else:
+            block = con.execute("""SELECT count, ts_data, value_data FROM sample_blocks WHERE tag_id = ? AND first_ts < ?
+                                ORDER BY first_ts DESC LIMIT 1""", (key, int(ts))).fetchone()
+        if block is not None:
+            block_ts = decode_timestamps(block[1], block[0])
+            i = np.searchsorted(block_ts, ts, side="right") if after else np.searchsorted(block_ts, ts) - 1
+            candidates.append((int(block_ts[i]), float(decode_values(block[2], block[0])[i])))
+
+        candidates.append(con.execute(f"""SELECT ts, value FROM samples WHERE tag_id = ? AND ts {comparison} ? AND value IS NOT NULL
+                                        ORDER BY ts {order} LIMIT 1""", (key, int(ts))).fetchone())
+
+    best = None
+    for candidate in candidates:
+        if candidate is not None and (best is None or (candidate[0] <= best[0] if after else candidate[0] >= best[0])):
+            best = candidate
+
+    if best is None:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    return np.array([best[0]], dtype=np.int64), np.array([best[1]], dtype=np.float64)
+
+#reads only the samples stored as rows, the ones written since the last compaction
+def read_hot_samples(con: Connection, key: int, start_ts: int, end_ts: int) -> tuple[np.ndarray, np.ndarray]:
+    cur = con.execute("""SELECT ts, value FROM samples
+                        WHERE tag_id = ? AND ts >= ? AND ts < ? AND value IS NOT NULL
+                        ORDER BY ts""", (key, int(start_ts), int(end_ts)))
+    rows = np.fromiter(cur, dtype=SAMPLE_DTYPE)
+    return rows["ts"], rows["value"]
+
+#returns the (first, last) timestamp of a tag key, or of all samples without a key, over every storage tier
+#sqlite only turns a lone MIN or MAX into an index seek, so every bound is its own subquery, one seek per tag
+def time_bounds(con: Connection, key: int | None = None) -> tuple[int | None, int | None]:
+    if key is None:
+        hot = con.execute("""SELECT MIN((SELECT MIN(ts) FROM samples WHERE samples.tag_id = tags.tag_id)),
+                                    MAX((SELECT MAX(ts) FROM samples WHERE samples.tag_id = tags.tag_id)) FROM tags""").fetchone()
+        blocks = con.execute("SELECT MIN(first_ts), MAX(last_ts) FROM sample_blocks").fetchone()
+    else:
+        hot = con.execute("""SELECT (SELECT MIN(ts) FROM samples WHERE tag_id = ?),
+                                    (SELECT MAX(ts) FROM samples WHERE tag_id = ?)""", (key, key)).fetchone()
+        blocks = con.execute("SELECT MIN(first_ts), MAX(last_ts) FROM sample_blocks WHERE tag_id = ?", (key,)).fetchone()
+    cold = archive.bounds(con, key)
+
+    firsts = [ts for ts in (hot[0], blocks[0], cold[0]) if ts is not None]
+    lasts = [ts for ts in (hot[1], blocks[1], cold[1]) if ts is not None]
+    return (min(firsts) if firsts else None), (max(lasts) if lasts else None)
+
+#reads the catalog entries of the given tag names, or of every tag without names
+#time range comes from the storage tiers, sample count and value range from the daily rollups, so no samples are scanned
+def read_catalog(con: Connection, names: list[str] | None = None) -> list[TagInfo]:
+    if names is None:
+        rows = con.execute("SELECT name, tag_id, constant, formula, materialized FROM tags").fetchall()
+    else:
+        placeholders = ",".join("?" * len(names))
+        rows = con.execute(f"SELECT name, tag_id, constant, formula, materialized FROM tags WHERE name IN ({placeholders})", names).fetchall()
+
+    infos = []
+    for name, key, constant, formula, materialized in rows:
+        if constant is not None:
+            infos.append(TagInfo(name, "constant", minimum=constant, maximum=constant))
+        elif formula is not None and not materialized:
+            infos.append(TagInfo(name, "formula"))
+        else:
+            first, last = time_bounds(con, key)
+            count, minimum, maximum = con.execute(f"SELECT SUM(count), MIN(min), MAX(max) FROM {ROLLUP_TIERS[-1][0]} WHERE tag_id = ?", (key,)).fetchone()
+            infos.append(TagInfo(name, "materialized" if formula is not None else "raw", first, last, count or 0, minimum, maximum))
+    return infos
+
+#refreshes the in memory catalog for the given tag names, or rebuilds it from every tag without names
+def load_catalog(con: Connection, names: list[str] | None = None) -> None:
+    if names is not None and not names:
+        return
+    catalog.update(read_catalog(con, names), replace_all=names is None)
+
+#computes count/min/max/mean/first/last per bucket of a sorted series in one vectorized pass
+def aggregate_buckets(ts: np.ndarray, values: np.ndarray, width: int) -> dict[str, np.ndarray]:
+    bucket = ts - ts % width
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(ts)]
+    count = ends - starts
+
+    return {
+        "bucket": bucket[starts],
+        "count": count,
+        "min": np.minimum.reduceat(values, starts),
+        "max": np.maximum.reduceat(values, starts),
+        "mean": np.add.reduceat(values, starts) / count,
+        "first": values[starts],
+        "last": values[ends - 1],
+    }
+
+#recomputes every rollup bucket touched by samples between start_ts and end_ts (inclusive)
+#the range is widened to whole days so each bucket is rebuilt from all of its samples
+def update_rollups(con: Connection, key: int, start_ts: int, end_ts: int) -> None:
+    day = ROLLUP_TIERS[-1][1]
+    start_ts = start_ts - start_ts % day
+    end_ts = end_ts - end_ts % day + day
+
+    for slice_start in range(start_ts, end_ts, ROLLUP_SLICE):
+        slice_end = min(slice_start + ROLLUP_SLICE, end_ts)
+        ts, values = read_samples(con, key, slice_start, slice_end)
+
+        for table, width in ROLLUP_TIERS:
+            #buckets in the slice that no longer have samples are removed
+            con.execute(f"DELETE FROM {table} WHERE tag_id = ? AND bucket >= ? AND bucket < ?", (key, slice_start, slice_end))
+            if not len(ts):
+                continue
+
+            stats = aggregate_buckets(ts, values, width)
+            con.executemany(f"""INSERT INTO {table} (tag_id, bucket, count, min, max, mean, first, last)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                            zip(repeat(key), stats["bucket"].tolist(), stats["count"].tolist(), stats["min"].tolist(),
+                                stats["max"].tolist(), stats["mean"].tolist(), stats["first"].tolist(), stats["last"].tolist()))
+
+#builds the rollups of tags that have samples but no rollups yet, e.g. after migrating an older database
+def backfill_rollups(con: Connection) -> None:
+    table = ROLLUP_TIERS[-1][0]
+    missing = con.execute(f"""SELECT tag_id FROM tags
+                            WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.tag_id = tags.tag_id)""").fetchall()
+
+    for (key,) in missing:
+        first, last = time_bounds(con, key)
+        if first is None:
+            continue
+        with con:
+            update_rollups(con, key, first, last)
 
-#creates process data database and populates with data from data.csv
-def initialize_db(con: Connection) -> None:
+#returns the coarsest rollup tier whose buckets are no wider than the resolution, so the fewest rows are read
+#returns None when the resolution is finer than every tier and the raw samples have to be read
+def pick_tier(resolution: int | None) -> tuple[str, int] | None:
+    if resolution is None:
+        return None
+    tiers = [tier for tier in ROLLUP_TIERS if tier[1] <= resolution]
+    return tiers[-1] if tiers else None
+
+#returns the rollup rows of a tag key for buckets that start between start_ts and end_ts
+#agg picks the stat used as the value, "minmax" returns the min and the max of every bucket so spikes survive
+def read_rollup(con: Connection, key: int, table: str, start_ts: int, end_ts: int, agg: str = "mean") -> tuple[np.ndarray, np.ndarray]:
+    cur = con.execute(f"""SELECT bucket, min, max, mean, first, last FROM {table}
+                        WHERE tag_id = ? AND bucket >= ? AND bucket <= ?
+                        ORDER BY bucket""", (key, int(start_ts), int(end_ts)))
+    rows = np.fromiter(cur, dtype=ROLLUP_DTYPE)
+
+    if agg == "minmax":
+        return np.repeat(rows["bucket"], 2), np.column_stack([rows["min"], rows["max"]]).ravel()
+    return rows["bucket"], rows[agg]
+
+#reads several tag keys between start_ts and end_ts (inclusive) in one query, from the samples or from a rollup tier (bucket means)
+#the rows come back ordered by (tag_id, ts) and are split into {key: (ts, values)} without copying
+def read_many(con: Connection, keys: list[int], start_ts: int, end_ts: int, tier: tuple[str, int] | None = None) -> dict[int, tuple[np.ndarray, np.ndarray]]:
+    if not keys:
+        return {}
+
+    placeholders = ",".join("?" * len(keys))
+    if tier is None:
+        query = f"""SELECT tag_id, ts, value FROM samples
+                    WHERE tag_id IN ({placeholders}) AND ts >= ? AND ts <= ? AND value IS NOT NULL
+                    ORDER BY tag_id, ts"""
+    else:
+        query = f"""SELECT tag_id, bucket, mean FROM {tier[0]}
+                    WHERE tag_id IN ({placeholders}) AND bucket >= ? AND bucket <= ?
+                    ORDER BY tag_id, bucket"""
+
+    rows = np.fromiter(con.execute(query, (*keys, int(start_ts), int(end_ts))), dtype=KEYED_SAMPLE_DTYPE)
+
+    #each tag is one contiguous run of rows
+    keys = sorted(keys)
+    starts = np.searchsorted(rows["tag_id"], keys, side="left")
+    ends = np.searchsorted(rows["tag_id"], keys, side="right")
+    series = {key: (rows["ts"][a:b], rows["value"][a:b]) for key, a, b in zip(keys, starts, ends)}
+
+    #rollups cover the whole history, raw samples may partly live in compressed blocks and the archive tier
+    if tier is None:
+        for key in keys:
+            series[key] = merge(archive.read(con, key, start_ts, end_ts + 1) + read_blocks(con, key, start_ts, end_ts + 1) + [series[key]])
+    return series
+
+#writes a wide dataframe (Time column + one column per tag) into the narrow samples table
+#returns the number of rows in the dataframe
+def append_frame(con: Connection, df: pd.DataFrame) -> int:
+    ts = pd.to_datetime(df["Time"], format="ISO8601").to_numpy(dtype="datetime64[us]").astype(np.int64)
+    appended = {}
+    published = {}
+
+    with con:
+        for column in df.columns:
+            if column == "Time":
+                continue
+
+            key = get_tag_key(con, column, create=True)
+            values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64)
+
+            #empty cells are not stored, a missing sample is just a missing row
+            mask = ~np.isnan(values)
+            write_series(con, key, ts, values)
+
+            #keep the rollup tiers in step with the new samples
+            if mask.any():
+                update_rollups(con, key, int(ts[mask].min()), int(ts[mask].max()))
+                appended[column] = int(ts[mask].min())
+
+                order = np.argsort(ts[mask], kind="stable")
+                published[column] = (ts[mask][order], values[mask][order])
+
+        #formula tags reading the new samples are brought up to date in the same transaction
+        changed = refresh_formulas(con, appended)
+
+        #the versions tell cached windows of every process that these tags changed
+        if changed:
+            names = list(changed)
+            placeholders = ",".join("?" * len(names))
+            con.execute(f"UPDATE tags SET version = version + 1 WHERE name IN ({placeholders})", names)
+
+    #drop cached windows the new samples land in, only after the commit so a reload sees the new rows
+    #this includes the formula tags that read them, lazy ones are evaluated from their inputs on the next read
+    for name, start_ts in changed.items():
+        series_cache.invalidate(name, start_ts)
+
+    #keep the in memory catalog in step with the new samples and the formula tags that were recomputed
+    load_catalog(con, list(changed))
+
+    #open live trends get the new samples pushed to them
+    hub.publish(published)
+
+    return len(df)
+
+#returns the saved carry of a materialized formula tag, {step: (ts, value)}
+def load_carry(con: Connection, key: int) -> dict[int | str, tuple[int, float]]:
+    rows = con.execute("SELECT step, ts, value FROM formula_carry WHERE tag_id = ?", (key,))
+    return {int(step) if step.isdigit() else step: (ts, np.nan if value is None else value) for step, ts, value in rows}
+
+def save_carry(con: Connection, key: int, saved: dict[int | str, tuple[int, float]]) -> None:
+    con.execute("DELETE FROM formula_carry WHERE tag_id = ?", (key,))
+    con.executemany("INSERT INTO formula_carry (tag_id, step, ts, value) VALUES (?, ?, ?, ?)",
+                    [(key, str(step), ts, None if np.isnan(value) else value) for step, (ts, value) in saved.items()])
+
+#returns the carry keys of a formula, the indexes of its cumulative steps and the cumulative lazy tags it reads
+def carry_keys(con: Connection, formula: str) -> set[int | str]:
+    plan = compile_formula(formula)
+    steps = {i for i, step in enumerate(plan.steps) if step.op == "call" and step.value in CUMULATIVE}
+    return steps | {name for name, inner in lazy_formulas(con, plan.tags).items() if formula_reach(con, inner)[1]}
+
+#the last timestamp a carry is saved at, results up to it don't change when samples after the data's last are appended
+def carry_checkpoint(last: int, lookback: int) -> int:
+    return last - lookback - STREAM_OVERLAP
+
+#recomputes the materialized formula tags that read the changed tags, changed maps a tag to the first new timestamp
+#formulas of formulas are handled in dependency order, each only from the first result the new samples can change
+#(rolling windows and edges like derivatives reach back), so the work grows with the new samples, not with the history
+#cumulative formulas like integral continue from the carry saved by the last refresh, samples that land before that
+#checkpoint (late data) recompute them in full
+#returns changed extended with every formula tag whose results changed from which timestamp, lazy ones included
+def refresh_formulas(con: Connection, changed: dict[str, int]) -> dict[str, int]:
+    changed = dict(changed)
+    if not changed:
+        return changed
+
+    graph = formula_graph(con)
+    first, last = time_bounds(con)
+
+    for name in dependents(graph, changed):
+        start_ts = min(changed[tag] for tag in graph[name] if tag in changed)
+        key, formula, materialized = con.execute("SELECT tag_id, formula, materialized FROM tags WHERE name = ?", (name,)).fetchone()
+        lookback, cumulative = formula_reach(con, formula)
+
+        since = max(first, start_ts) - lookback - STREAM_OVERLAP
+        carry = Carry(checkpoint=carry_checkpoint(last, lookback))
+        if cumulative:
+            saved = load_carry(con, key) if materialized else {}
+            if saved and set(saved) == carry_keys(con, formula) and all(ts < since for ts, _ in saved.values()):
+                #start at the checkpoint so the first chunk holds the samples the carry was saved at
+                carry.offsets = saved
+                since = min(ts for ts, _ in saved.values())
+            else:
+                since = first - lookback - STREAM_OVERLAP
+        changed[name] = since
+        if not materialized:
+            continue
+
+        #results of the old samples can change too, rewrite the tag from since and rebuild its rollups over that range
+        delete_samples(con, key, since, np.iinfo(np.int64).max)
+        for chunk in stream_formula(con, formula, since=since, carry=carry):
+            write_series(con, key, chunk.ts, chunk.values)
+        update_rollups(con, key, since, last)
+        if cumulative:
+            save_carry(con, key, carry.saved)
+
+    return changed
+
+#moves data from the old wide process_data table (one TEXT column per tag) into the narrow samples table
+#runs in chunks so the wide table never has to fit in memory, the wide table is dropped once everything is copied
+def migrate_wide_table(con: Connection) -> None:
+    exists = con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'process_data'").fetchone()
+    if not exists:
+        return
+
+    for chunk in pd.read_sql("SELECT * FROM process_data", con, chunksize=100000):
+        append_frame(con, chunk)
+
+    with con:
+        con.execute("DROP TABLE process_data")
+
+#packs the row samples older than COMPACT_AFTER before the newest sample into compressed blocks of BLOCK_SAMPLES samples
+#a tag with less than a full block of old rows keeps them as rows until the block fills up
+def compact_samples(con: Connection) -> None:
+    last = time_bounds(con)[1]
+    if last is None:
+        return
+    cutoff = last - COMPACT_AFTER
+
+    old = con.execute("""SELECT tag_id, COUNT(*) FROM samples WHERE ts < ? AND value IS NOT NULL
+                        GROUP BY tag_id HAVING COUNT(*) >= ?""", (cutoff, BLOCK_SAMPLES)).fetchall()
+    for key, count in old:
+        #one block at a time, so compacting a big backlog never holds more than a block in memory
+        with con:
+            for _ in range(count // BLOCK_SAMPLES):
+                cur = con.execute("""SELECT ts, value FROM samples
+                                    WHERE tag_id = ? AND ts < ? AND value IS NOT NULL
+                                    ORDER BY ts LIMIT ?""", (key, cutoff, BLOCK_SAMPLES))
+                rows = np.fromiter(cur, dtype=SAMPLE_DTYPE)
+                if not len(rows):
+                    break
+                ts, values = rows["ts"], rows["value"]
+
+                #late samples may land inside existing blocks, those blocks are folded into the new one whole
+                #(with every row in their range) so blocks never overlap
+                first_ts, last_ts = con.execute("""SELECT MIN(first_ts), MAX(last_ts) FROM sample_blocks
+                                                WHERE tag_id = ? AND last_ts >= ? AND first_ts <= ?""", (key, int(ts[0]), int(ts[-1]))).fetchone()
+                if first_ts is not None:
+                    ts, values = read_sqlite_samples(con, key, min(first_ts, int(ts[0])), max(last_ts, int(ts[-1])) + 1)
+                delete_samples(con, key, int(ts[0]), int(ts[-1]) + 1)
+                write_block(con, key, ts, values)
+
+#moves whole partitions of samples older than ARCHIVE_AFTER before the newest sample from sqlite into the archive tier
+#reads merge both tiers, so nothing changes for the plots and formulas, the rollups stay in sqlite
+def archive_old_samples(con: Connection) -> None:
+    last = time_bounds(con)[1]
+    if last is None:
+        return
+    cutoff = last - ARCHIVE_AFTER
+    cutoff -= cutoff % ARCHIVE_PARTITION
+
+    old = con.execute("""SELECT tag_id, MIN(first) FROM (
+                            SELECT tag_id, MIN(ts) AS first FROM samples WHERE ts < ? GROUP BY tag_id
+                            UNION ALL
+                            SELECT tag_id, MIN(first_ts) AS first FROM sample_blocks WHERE first_ts < ? GROUP BY tag_id
+                        ) GROUP BY tag_id""", (cutoff, cutoff)).fetchall()
+    for key, first in old:
+        for start in range(first - first % ARCHIVE_PARTITION, cutoff, ARCHIVE_PARTITION):
+            ts, values = read_sqlite_samples(con, key, start, start + ARCHIVE_PARTITION)
+            if not len(ts):
+                continue
+
+            #the files are written before the rows are deleted, a crash in between leaves the samples in both tiers,
+            #which reads merge without duplicates
+            with con:
+                archive.write(con, key, start, ts, values)
+                delete_samples(con, key, start, start + ARCHIVE_PARTITION)
+
+#creates process data database and ingests any rows of data.csv that have not been loaded yet
+#only new rows are appended, so formula tags created with insert_new_tag are kept between loads
+def initialize_db(con: Connection, path: str = DATA_PATH) -> None:
     try:
-        #read the data.csv file into a pandas dataframe
-        df = pd.read_csv("data.csv")
+        create_schema(con)
+        migrate_wide_table(con)
+        backfill_rollups(con)
 
-        #insert the data into the database (to_sql will create the table if it doesn't exist)
-        df.to_sql("process_data", con, if_exists="replace", index=False)
+        rows = ingest_csv(con, path, append_frame)
+        if rows:
+            print(f"Ingested {rows} new rows from {path}")
+
+        settle_samples(con)
 
-        #print the data from the database, currently just a test
-        with con:
-            cur = con.cursor()
-            res = cur.execute("SELECT * FROM process_data")
-    
     except Exception as e:
         print(f"Unable to import data: {e}")
 
+#checks data.csv for rows appended while the server runs, only the ingest runs when nothing new arrived
+#compaction, archiving and the catalog reload only have something to do after new rows, ingested here
+#or written by another process (an upload or the poll of another worker), which changes the data version
+def poll_data(con: Connection, path: str = DATA_PATH) -> None:
+    try:
+        rows = ingest_csv(con, path, append_frame)
+        if rows:
+            print(f"Ingested {rows} new rows from {path}")
+
+        if rows or con.execute("PRAGMA data_version").fetchone()[0] != catalog.data_version:
+            settle_samples(con)
+
+    except Exception as e:
+        print(f"Unable to poll for new data: {e}")
+
+#packs and archives old samples after new rows were written and reloads the whole catalog
+#uploads call it once they finished, their writes go through this process' writer and don't change its data version
+def settle_samples(con: Connection) -> None:
+    compact_samples(con)
+    archive_old_samples(con)
+    reload_catalog(con)
+
+#rebuilds the whole catalog and remembers the data version of the connection it was read with
+def reload_catalog(con: Connection) -> None:
+    catalog.data_version = con.execute("PRAGMA data_version").fetchone()[0]
+    load_catalog(con)
+
+#updates how many points per trace are plotted and how the series are reduced to that many points
+def update_resolution(max_points: int, method: str, user: User) -> None:
+    try:
+        user.max_points = max_points
+        user.downsample = method
+    except Exception as e:
+        print(f"Unable to update plot resolution: {e}")
+
 def update_preferences(time_frame: float, user: User) -> None:
     try:
         user.time_frame = time_frame
@@ -30,94 +624,330 @@ def update_preferences(time_frame: float, user: User) -> None:
     except Exception as e:
         print(f"Unable to update user preferences: {e}")
 
-#return df object for given tag id
-def get_df(con: Connection, tag_id: str) -> pd.DataFrame:
-    try:
-        #validate if df follows correct regex pattern
-        if not re.match(r'^[a-zA-Z0-9_ ]+$', tag_id):
-            return HTMLResponse(f"Invalid tag ID format.")
-        
-        #pd.read_sql to get a DataFrame directly
-        #select Time and the tag_id column, filter where tag_id is not NULL
-        df = pd.read_sql(f"SELECT Time, {tag_id} FROM process_data WHERE {tag_id} IS NOT NULL", con)
-        return df
-        
-    except Exception as e:
-        print(f"Unable to get df object for tag id: {e}")
+#returns the samples of a tag between start and end (inclusive) as typed arrays
+#ts holds int64 epoch microseconds and values holds float64, no per-render parsing needed
+#resolution is the time per point the caller needs in microseconds, when a rollup tier is that coarse its buckets are read instead of raw samples
+def read_series(con: Connection, tag_id: str, start: datetime | None = None, end: datetime | None = None,
+                resolution: int | None = None, agg: str = "mean") -> tuple[np.ndarray, np.ndarray]:
+    start_ts = to_epoch_us(start) if start is not None else np.iinfo(np.int64).min
+    end_ts = to_epoch_us(end) if end is not None else np.iinfo(np.int64).max - 1
+
+    row = con.execute("SELECT tag_id, constant, formula, materialized FROM tags WHERE name = ?", (tag_id,)).fetchone()
+    if row is None:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    key, constant, formula, materialized = row
+
+    #a formula tag that is not materialized has no samples, it is evaluated for just the window being read
+    if formula is not None and not materialized:
+        return evaluate_formula(con, formula, start, end, resolution)
+
+    #a constant tag has no samples, it is drawn as a flat line over the window (or over the whole dataset)
+    if constant is not None:
+        if start is None or end is None:
+            first, last = time_bounds(con)
+            if first is None:
+                return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+            start_ts = max(start_ts, first)
+            end_ts = min(end_ts, last)
+        return np.array([start_ts, end_ts], dtype=np.int64), np.full(2, constant, dtype=np.float64)
+
+    tier = pick_tier(resolution)
+    if tier is not None:
+        return read_rollup(con, key, tier[0], start_ts, end_ts, agg)
+    return read_samples(con, key, start_ts, end_ts + 1)
+
+#returns a fetch function for the formula parser that reads all tags of a formula over one window at once
+#constant tags come back as a number, every other tag as a signal of typed arrays
+#stored tags are read with a single query however many tags the formula uses or how often it repeats them
+#every stored tag also brings its last sample before the window and its first sample after it, so the alignment
+#policies can fill the edges of the window from a tag that is sampled less often than the window is long
+def window_fetcher(con: Connection, start: datetime | None, end: datetime | None, resolution: int | None = None):
+    start_ts = to_epoch_us(start) if start is not None else np.iinfo(np.int64).min
+    end_ts = to_epoch_us(end) if end is not None else np.iinfo(np.int64).max - 1
+
+    def fetch(tag_ids: frozenset[str]) -> dict[str, Signal | float]:
+        names = sorted(tag_ids)
+        placeholders = ",".join("?" * len(names))
+        rows = con.execute(f"""SELECT name, tag_id, constant, formula, materialized FROM tags
+                                WHERE name IN ({placeholders})""", names).fetchall()
+
+        results = {name: Signal(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)) for name in names}
+        stored = {}
+        for name, key, constant, formula, materialized in rows:
+            if constant is not None:
+                results[name] = constant
+            elif formula is not None and not materialized:
+                results[name] = Signal(*evaluate_formula(con, formula, start, end, resolution))
+            else:
+                stored[key] = name
+
+        tier = pick_tier(resolution)
+        for key, (ts, values) in read_many(con, list(stored), start_ts, end_ts, tier).items():
+            parts = [(ts, values)]
+            if start is not None:
+                parts.insert(0, neighbour_sample(con, key, start_ts, tier))
+            if end is not None:
+                parts.append(neighbour_sample(con, key, end_ts, tier, after=True))
+            results[stored[key]] = Signal(*merge(parts))
+        return results
+    return fetch
+
+#returns {tag name: formula} of the lazy formula tags among the given tags, they are evaluated when they are read
+def lazy_formulas(con: Connection, tag_ids: Iterable[str]) -> dict[str, str]:
+    names = sorted(tag_ids)
+    if not names:
+        return {}
+    placeholders = ",".join("?" * len(names))
+    rows = con.execute(f"""SELECT name, formula FROM tags
+                            WHERE name IN ({placeholders}) AND formula IS NOT NULL AND constant IS NULL AND NOT materialized""", names)
+    return dict(rows.fetchall())
+
+#returns the (lookback, cumulative) of a formula including the lazy formula tags it reads, at any depth
+#a lazy input is evaluated over the window the formula reads, so its own windows reach back further on top of the formula's
+def formula_reach(con: Connection, formula: str) -> tuple[int, bool]:
+    plan = compile_formula(formula)
+    lookback, cumulative = 0, plan.cumulative
+    for inner in lazy_formulas(con, plan.tags).values():
+        inner_lookback, inner_cumulative = formula_reach(con, inner)
+        lookback = max(lookback, inner_lookback)
+        cumulative = cumulative or inner_cumulative
+    return plan.lookback + lookback, cumulative
+
+#evaluates a formula over the window and returns the result as typed arrays
+#the inputs are read from the history the rolling windows of the formula need before the window on, so the first
+#results of the window are the same as over the whole history, the result is trimmed back to the window
+#inputs that are formula tags themselves are evaluated over that wider window, a constant result is drawn as a flat line
+#tags with different sample times are lined up with the alignment policy before they are combined
+def evaluate_formula(con: Connection, formula: str, start: datetime | None, end: datetime | None,
+                     resolution: int | None = None, alignment: str = DEFAULT_ALIGNMENT) -> tuple[np.ndarray, np.ndarray]:
+    plan = compile_formula(formula)
+    fetch_start = from_epoch_us(to_epoch_us(start) - plan.lookback) if start is not None else None
+    result = plan.run(window_fetcher(con, fetch_start, end, resolution), alignment)
+
+    #the samples around the window only fill its edges, results outside of it are dropped
+    if isinstance(result, Signal):
+        keep = np.ones(len(result), dtype=bool)
+        if start is not None:
+            keep &= result.ts >= to_epoch_us(start)
+        if end is not None:
+            keep &= result.ts <= to_epoch_us(end)
+        return result.ts[keep], result.values[keep]
+
+    if start is None or end is None:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    return np.array([to_epoch_us(start), to_epoch_us(end)], dtype=np.int64), np.full(2, float(result))
+
+#evaluates a formula over the whole history one chunk at a time and yields the result of every chunk
+#only the samples of one chunk (plus the history its rolling windows need) are in memory at once
+#reading past both ends of the chunk keeps alignment and derivatives at the edges the same as in a single pass,
+#cumulative functions like integral continue from the value the previous chunk ended on, and so do lazy formula tags
+#the formula reads that accumulate, their windows count towards the history read before every chunk
+#since starts the result at that timestamp instead of at the first sample, only [since - reach, last] is read
+#carry continues cumulative results from a previous evaluation and collects its checkpoint (see Carry)
+def stream_formula(con: Connection, formula: str, alignment: str = DEFAULT_ALIGNMENT, since: int | None = None,
+                   carry: Carry | None = None) -> Iterator[Signal]:
+    plan = compile_formula(formula)
+    lookback, _ = formula_reach(con, formula)
+    stitched = [key for key in carry_keys(con, formula) if isinstance(key, str)]
+    first, last = time_bounds(con)
+    if first is None:
+        return
+    if since is not None:
+        first = max(first, since)
+
+    #the first chunk keeps results stamped before its first sample, e.g. the period a resample starts in
+    floor = since if since is not None else np.iinfo(np.int64).min
+
+    reach = STREAM_OVERLAP + lookback
+    if carry is None:
+        carry = Carry()
+
+    #chunks are aligned to STREAM_CHUNK, except that a refresh starts its first chunk right at since
+    chunk_start = first if since is not None else first - first % STREAM_CHUNK
+    while chunk_start <= last:
+        carry.start, carry.end = chunk_start, chunk_start - chunk_start % STREAM_CHUNK + STREAM_CHUNK
+        chunk_start = carry.end
+        inputs = window_fetcher(con, from_epoch_us(carry.start - reach), from_epoch_us(carry.end + reach))
+
+        def fetch(tag_ids: frozenset[str]) -> dict[str, Signal | float]:
+            results = inputs(tag_ids)
+            for name in stitched:
+                results[name] = carry.stitch(name, results[name])
+            return results
+
+        result = plan.run(fetch, alignment, carry)
+
+        if isinstance(result, Signal):
+            keep = (result.ts >= floor) & (result.ts < carry.end)
+            yield Signal(result.ts[keep], result.values[keep])
+        floor = carry.end
+
+#evaluates a formula over the last FORMULA_TRIAL of the data, raises whatever the evaluation raises
+#returns the result (a signal, or a number for formulas that reduce the window to one value), None without data
+def trial_formula(con: Connection, formula: str) -> Signal | float | None:
+    last = time_bounds(con)[1]
+    if last is None:
         return None
+    return parse_formula(formula, window_fetcher(con, from_epoch_us(last - FORMULA_TRIAL), from_epoch_us(last)))
+
+#creates a formula tag, by default only the expression is stored and it is evaluated lazily for the window being read
+#materialize evaluates the whole history once and stores the result as samples, worth it for expensive formulas
+#formulas without tags are constants and are always stored as a value
+def create_formula_tag(con: Connection, tag: Tag, formula: str, materialize: bool = False) -> None:
+    referenced = formula_tags(formula)
+
+    if get_tag_key(con, tag.id) is not None:
+        raise ValueError(f"Tag {tag.id} already exists")
+    if tag.id in referenced:
+        raise ValueError(f"Formula can't reference the tag it creates ({tag.id})")
+
+    missing = sorted(name for name in referenced if get_tag_key(con, name) is None)
+    if missing:
+        raise ValueError(f"Unknown tags: {', '.join(missing)}")
+
+    #a formula that fails on the samples it reads is refused before anything is stored
+    #so is materializing a formula that reduces the window to one number, it has no samples to store
+    if referenced:
+        trial = trial_formula(con, formula)
+        if materialize and trial is not None and not isinstance(trial, Signal):
+            raise ValueError(f"{formula} reduces the window to a single value, only formulas with a value per sample can be materialized")
+
+    #a formula without tags is a constant, it is stored as is
+    if not referenced:
+        tag.data = float(parse_formula(formula, window_fetcher(con, None, None)))
+        insert_new_tag(con, tag, formula)
+
+    #the history is evaluated and written chunk by chunk so it never has to fit in memory
+    #cumulative formulas keep their carry, so refreshes continue from it instead of starting over
+    elif materialize:
+        lookback, cumulative = formula_reach(con, formula)
+        last = time_bounds(con)[1]
+        carry = Carry(checkpoint=carry_checkpoint(last, lookback) if last is not None else None)
+        insert_new_tag(con, tag, formula, materialized=True, chunks=stream_formula(con, formula, carry=carry))
+        if cumulative:
+            with con:
+                save_carry(con, get_tag_key(con, tag.id), carry.saved)
+
+    else:
+        insert_new_tag(con, tag, formula)
 
 #insert formula tag into database
-def insert_new_tag(con: Connection, tag: Tag) -> None:
-    try:
-        
-        with con:
-            cur = con.cursor()
-            #create new column with the new tag id
-            cur.execute(f'ALTER TABLE process_data ADD COLUMN "{tag.id}" TEXT')
-            updated_data = []
-
-            #insert the value and rowid into updated data list
-            #can introduce latency if there is a large amount of data, could be optimized more
-            #if the result is a dataframe, insert the values into the database
-            if isinstance(tag.data, pd.DataFrame):
-                for i, value in enumerate(tag.data[tag.data.columns[1]]):
-                    updated_data.append((value, i+1))
-
-            #if the result is a constant, insert the value into the database for each entry in the time column
-            elif isinstance(tag.data, float):
-                with con:
-                    cur = con.cursor()
-                    cur.execute("""SELECT COUNT(*) FROM process_data""")
-                    rows = cur.fetchone()[0]
-
-                for i in range(rows):
-                    updated_data.append((tag.data, i+1))
-
-            #write the updated data to the database
-            cur.executemany(f'UPDATE process_data SET "{tag.id}" = ? WHERE rowid = ?', updated_data)
-            con.commit()
+#formula is stored with the tag, materialized marks that its samples were written and it doesn't have to be evaluated on read
+#chunks are the samples of a streamed formula, every chunk is written and rolled up before the next one is evaluated
+def insert_new_tag(con: Connection, tag: Tag, formula: str | None = None, materialized: bool = False,
+                   chunks: Iterable[Signal] = ()) -> None:
+    #a failure rolls the whole tag back and is raised to the caller
+    with con:
+        cur = con.cursor()
+        #tag names are unique, refuse to overwrite an existing tag
+        if get_tag_key(con, tag.id) is not None:
+            raise ValueError(f"Tag {tag.id} already exists")
+
+        #add the new tag id to the tag catalog
+        key = get_tag_key(con, tag.id, create=True)
+        cur.execute("UPDATE tags SET formula = ?, materialized = ? WHERE tag_id = ?", (formula, int(materialized), key))
+
+        #if the result is a dataframe, write the whole series to the database in one bulk insert
+        if isinstance(tag.data, pd.DataFrame):
+            times = tag.data["Time"].to_numpy(dtype="datetime64[us]").astype(np.int64)
+            values = tag.data[tag.data.columns[1]].to_numpy(dtype=np.float64)
+            write_series(con, key, times, values)
+
+            #build the rollup tiers of the new tag
+            if len(times):
+                update_rollups(con, key, int(times.min()), int(times.max()))
+
+        #if the result is a constant, store it once in the tag catalog instead of once per timestamp
+        elif isinstance(tag.data, float):
+            cur.execute("UPDATE tags SET constant = ? WHERE tag_id = ?", (tag.data, key))
+
+        for chunk in chunks:
+            write_series(con, key, chunk.ts, chunk.values)
+            if len(chunk):
+                update_rollups(con, key, int(chunk.ts[0]), int(chunk.ts[-1]))
+
+    #a session may have asked for the tag before it existed, drop those empty windows
+    series_cache.invalidate(tag.id)
+    load_catalog(con, [tag.id])
 
-    except Exception as e:
-        print(f"Unable to insert new tag into database: {e}")
-            
 #plots data for given tag id and returns html
-def generate_plots(con_data: Connection, user: User) -> HTMLResponse:
+#renders the plot of one tag, runs on a worker thread with the read connection of that thread
+def render_plot(tag: Tag, start_time: datetime, end_time: datetime, max_points: int, method: str) -> str:
+    con = pool.reader()
+
+    #read the samples in the window as typed arrays and hand them to the plot
+    ts, values = get_plot_series(con, tag.id, start_time, end_time, max_points, method)
+    stored_plot_html = Tag.plot(tag, ts, values)
+
+    #the trend class and tag let the page refresh the trace in place through /series
+    return f'<div id="plot" class="trend" data-tag="{tag.id}">{stored_plot_html}</div>'
+
+#plots every tag on the worker pool in parallel and returns the html of all plots in order
+async def generate_plots(user: User, tags: list[Tag] | None = None) -> HTMLResponse:
     #initialize string to store html for all plots
     wrapped_html = ""
-    stored_plot_html = ""
+
+    #only render the given tags (e.g. a newly added one), defaults to every plot of the user
+    if tags is None:
+        tags = user.current_plots
 
     #get time frame from user
     try:
-        # anchor_time is already a datetime object, no need to parse
-        if isinstance(user.anchor_time, str):
-            end_time = datetime.strptime(user.anchor_time, "%Y-%m-%d %H:%M:%S")
-        else:
-            end_time = user.anchor_time
-        start_time = end_time - timedelta(minutes=user.time_frame)
+        start_time, end_time = get_window(user)
 
-        for tag in user.current_plots:
+        #a tag that fails to plot gets an error in its place, the other plots are still rendered
+        plots = await asyncio.gather(*(
+            run_blocking(user.session_token, render_plot, tag, start_time, end_time, user.max_points, user.downsample)
+            for tag in tags
+        ), return_exceptions=True)
 
-            stored_plot_html = Tag.plot(tag, con_data, start_time, end_time)
-            wrapped_html += f'<div id="plot">{stored_plot_html}</div>'
+        for tag, plot in zip(tags, plots):
+            if isinstance(plot, Exception):
+                print(f"Unable to plot tag {tag.id}: {plot}")
+                plot = f'<div id="plot" class="trend-error" data-tag="{tag.id}"><h1>Error plotting data for tag {tag.id}</h1><p>{plot}</p></div>'
+            wrapped_html += plot
 
     except Exception as e:
         print(f"Unable to generate plots: {e}")
 
     return wrapped_html
 
-def update_anchor_time(con_data: Connection, user: User, operation: str) -> None:
+#returns the (start, end) window the user is looking at
+def get_window(user: User) -> tuple[datetime, datetime]:
+    # anchor_time is already a datetime object, no need to parse
+    if isinstance(user.anchor_time, str):
+        end_time = datetime.strptime(user.anchor_time, "%Y-%m-%d %H:%M:%S")
+    else:
+        end_time = user.anchor_time
+    start_time = end_time - timedelta(minutes=user.time_frame)
+    return start_time, end_time
+
+#returns the series of a tag in the window reduced to at most max_points samples with the given method
+#results are kept in the shared window cache, so sessions looking at the same window share one read
+def get_plot_series(con: Connection, tag_id: str, start_time: datetime, end_time: datetime, max_points: int, method: str) -> tuple[np.ndarray, np.ndarray]:
+    start_ts, end_ts = to_epoch_us(start_time), to_epoch_us(end_time)
+
+    def load() -> tuple[np.ndarray, np.ndarray]:
+        #time covered by one plotted point, exact plots always read raw samples
+        resolution = None
+        if method != "exact":
+            resolution = (end_ts - start_ts) // max_points
+
+        #long windows read min/max buckets from the coarsest rollup tier that still gives about one bucket per point
+        #the series is reduced to about the plot width so long windows stay small in the browser
+        ts, values = read_series(con, tag_id, start_time, end_time, resolution, agg="minmax")
+        return downsample(ts, values, max_points, method)
+
+    #a window cached before another process wrote to the tag is read again
+    return series_cache.get((tag_id, start_ts, end_ts, max_points, method), load, get_tag_version(con, tag_id))
+
+#the dataset bounds come from the in memory catalog, a navigation click never touches the database
+def update_anchor_time(user: User, operation: str) -> None:
     #update the anchor time to be the oldest point + current time frame
     if operation == "go_past":
         try:
-            with con_data:
-                cur = con_data.cursor()
-
-                #find the oldest entry in the process data database
-                cur.execute("""SELECT MIN(Time)
-                            FROM process_data
-                """)
-            first_point = cur.fetchone()[0]
-            first_point = datetime.strptime(first_point, "%Y-%m-%d %H:%M:%S")
+            #find the oldest entry in the process data
+            first_point = catalog.bounds()[0]
             
             #update anchor point to be the oldest point + the current timeframe
             new_anchor = first_point + timedelta(minutes=user.time_frame)   
@@ -135,16 +965,8 @@ def update_anchor_time(con_data: Connection, user: User, operation: str) -> None
             #check if the user is trying to step previous to the oldest datapoint in the set
             #if so, set the anchor point to be the oldest point in the set + the current timeframe
             try:
-                with con_data:
-                    cur = con_data.cursor()
-
-                    #find the oldest entry in the process data database
-                    cur.execute("""SELECT MIN(Time)
-                                    FROM process_data
-                    """)
-                    first_point = cur.fetchone()[0]
-                    
-                first_point = datetime.strptime(first_point, "%Y-%m-%d %H:%M:%S")
+                #find the oldest entry in the process data
+                first_point = catalog.bounds()[0]
 
             except Exception as e:
                 print(f"Unable to find oldest database entry: {e}")
@@ -185,32 +1007,15 @@ def update_anchor_time(con_data: Connection, user: User, operation: str) -> None
     #but in CSV format when the data is updated intermittently, we will need to read the most recent data point and use that as our anchor point
     if operation == "go_present":
         try:
-            with con_data:
-                cur = con_data.cursor()
-
-                #find the newest/most recent entry in the process data database
-                cur.execute("""SELECT MAX(Time)
-                            FROM process_data
-                """)
-            most_recent_point = cur.fetchone()[0]
-            most_recent_point = datetime.strptime(most_recent_point, "%Y-%m-%d %H:%M:%S")
-            
+            #find the newest/most recent entry in the process data
+            most_recent_point = catalog.bounds()[1]
+
+            #the catalog is empty until the first rows are ingested, keep the current anchor until then
+            if most_recent_point is None:
+                return
+
             #update anchor point to be the oldest point + the current timeframe
             user.anchor_time = most_recent_point
  
         except Exception as e:
             print(f"Unable to update anchor time: {e}")
-
-
-def create_float_df(result: float, new_tag_id: str, con_data: Connection) -> pd.DataFrame:
-    with con_data:
-        cur = con_data.cursor()
-        cur.execute("""SELECT MAX(TIME) FROM process_data""")
-        max_time = cur.fetchone()[0]
-        max_time = datetime.strptime(max_time, "%Y-%m-%d %H:%M:%S")
-    rows = 1
-    cols = [new_tag_id]
-    return pd.DataFrame(data=np.full(rows, cols, result), columns=cols)
-
-    
-        
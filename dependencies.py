@@ -0,0 +1,21 @@
+from graphlib import TopologicalSorter
+from sqlite3 import Connection
+from typing import Iterable
+
+from parser import formula_tags
+
+#formula tag -> the tags its formula reads, for every formula tag in the catalog
+def formula_graph(con: Connection) -> dict[str, set[str]]:
+    rows = con.execute("SELECT name, formula FROM tags WHERE formula IS NOT NULL").fetchall()
+    return {name: formula_tags(formula) for name, formula in rows}
+
+#returns the formula tags that read any of the changed tags, directly or through other formula tags
+#the tags come in topological order, every formula tag after all the formula tags it reads
+def dependents(graph: dict[str, set[str]], changed: Iterable[str]) -> list[str]:
+    stale = set(changed)
+    ordered = []
+    for name in TopologicalSorter(graph).static_order():
+        if name in graph and stale & graph[name]:
+            stale.add(name)
+            ordered.append(name)
+    return ordered
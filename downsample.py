@@ -0,0 +1,75 @@
+import numpy as np
+
+#default number of points per trace, roughly the pixel width of a plot
+MAX_POINTS = 1500
+
+#supported downsampling methods, exact returns every sample in the window
+METHODS = ["minmax", "lttb", "exact"]
+
+#keeps the minimum and the maximum sample of each bucket, in time order, so spikes stay visible
+#buckets hold an equal number of samples, the output has at most max_points samples
+def minmax(ts: np.ndarray, values: np.ndarray, max_points: int) -> tuple[np.ndarray, np.ndarray]:
+    n = len(values)
+    if n <= max_points or max_points < 2:
+        return ts, values
+
+    #each bucket contributes two points, pad the last bucket so the values reshape into (buckets, size)
+    size = -(-n // (max_points // 2))
+    buckets = -(-n // size)
+    padded = buckets * size
+
+    low = np.full(padded, np.inf)
+    low[:n] = values
+    high = np.full(padded, -np.inf)
+    high[:n] = values
+
+    offsets = np.arange(buckets) * size
+    i_min = low.reshape(buckets, size).argmin(axis=1) + offsets
+    i_max = high.reshape(buckets, size).argmax(axis=1) + offsets
+
+    #sort the two picks of every bucket by time and drop duplicates when min and max are the same sample
+    index = np.unique(np.concatenate([i_min, i_max]))
+    return ts[index], values[index]
+
+#largest triangle three buckets, keeps the sample of each bucket that forms the largest triangle
+#with the previously kept sample and the average of the next bucket, the first and last samples are always kept
+def lttb(ts: np.ndarray, values: np.ndarray, max_points: int) -> tuple[np.ndarray, np.ndarray]:
+    n = len(values)
+    if n <= max_points or max_points < 3:
+        return ts, values
+
+    #work on float times relative to the first sample to keep the triangle areas precise
+    x = (ts - ts[0]).astype(np.float64)
+    y = values
+
+    #bucket edges for the n - 2 samples between the first and last sample
+    edges = np.linspace(1, n - 1, max_points - 1).astype(np.int64)
+
+    index = np.empty(max_points, dtype=np.int64)
+    index[0] = 0
+    index[-1] = n - 1
+    a = 0
+
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+
+        #average point of the next bucket (the last sample for the final bucket)
+        next_start = end
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        #triangle area for every candidate in the bucket, computed in one vectorized step
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        index[i + 1] = a
+
+    return ts[index], values[index]
+
+#reduces a series to at most max_points samples with the given method
+def downsample(ts: np.ndarray, values: np.ndarray, max_points: int = MAX_POINTS, method: str = "minmax") -> tuple[np.ndarray, np.ndarray]:
+    if method == "exact":
+        return ts, values
+    if method == "lttb":
+        return lttb(ts, values, max_points)
+    return minmax(ts, values, max_points)
@@ -0,0 +1,166 @@
+from functools import reduce
+from typing import Callable
+import numpy as np
+
+from signals import Signal, combine
+
+#functions that formulas can call, every argument is a signal or a constant and so is the result
+#time arguments (windows, resample periods) are constants in seconds, timestamps are epoch microseconds
+US_PER_SECOND = 1_000_000
+
+#returns a time argument in microseconds, it has to be a positive number
+def seconds(name: str, value: Signal | float) -> int:
+    if isinstance(value, Signal) or value <= 0:
+        raise ValueError(f'{name} needs a positive number of seconds')
+    return int(value * US_PER_SECOND)
+
+#applies a numpy function to the values of a signal or to a constant
+def elementwise(fn: Callable[[np.ndarray], np.ndarray], x: Signal | float) -> Signal | float:
+    if isinstance(x, Signal):
+        return Signal(x.ts, fn(x.values))
+    return float(fn(x))
+
+#rate of change per second, central differences that account for uneven sample spacing
+def derivative(x: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal):
+        return 0.0
+    if len(x) < 2:
+        return Signal(x.ts, np.full(len(x), np.nan))
+    return Signal(x.ts, np.gradient(x.values, (x.ts - x.ts[0]) / US_PER_SECOND))
+
+#running integral over the window in value * seconds with the trapezoidal rule, gaps (NaN) add nothing
+def integral(x: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal):
+        raise ValueError('integral needs a tag')
+    if len(x) == 0:
+        return x
+
+    dt = np.diff(x.ts) / US_PER_SECOND
+    area = np.nan_to_num((x.values[1:] + x.values[:-1]) / 2 * dt)
+    return Signal(x.ts, np.concatenate([[0.0], np.cumsum(area)]))
+
+#index of the first sample of the window (ts - window, ts] that ends at every sample
+def window_starts(ts: np.ndarray, window: int) -> np.ndarray:
+    return np.searchsorted(ts, ts - window, side='right')
+
+#sum and count of the valid samples of every window, from cumulative sums so the cost doesn't grow with the window
+def window_sums(values: np.ndarray, starts: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    valid = ~np.isnan(values)
+    total = np.concatenate([[0.0], np.cumsum(np.where(valid, values, 0.0))])
+    count = np.concatenate([[0], np.cumsum(valid)])
+    ends = np.arange(1, len(values) + 1)
+    return total[ends] - total[starts], count[ends] - count[starts]
+
+def rolling_mean(x: Signal | float, window: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal):
+        return x
+    starts = window_starts(x.ts, seconds('rolling_mean window', window))
+    total, count = window_sums(x.values, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return Signal(x.ts, total / count)
+
+#sample standard deviation of every window, the values are shifted by their mean first to keep the sums of squares precise
+def rolling_std(x: Signal | float, window: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal):
+        return 0.0
+    starts = window_starts(x.ts, seconds('rolling_std window', window))
+    shifted = x.values - np.nanmean(x.values) if len(x) else x.values
+    total, count = window_sums(shifted, starts)
+    squares, _ = window_sums(shifted * shifted, starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        variance = (squares - total * total / count) / (count - 1)
+    return Signal(x.ts, np.sqrt(np.maximum(variance, 0.0)))
+
+#minimum or maximum of every window from a sparse table of power of two blocks
+#any window is covered by two overlapping blocks, so each lookup is one vectorized step for all windows of the same size
+def rolling_extreme(op: np.ufunc, x: Signal, window: int) -> Signal:
+    n = len(x)
+    if n == 0:
+        return x
+
+    starts = window_starts(x.ts, window)
+    ends = np.arange(n)
+    levels = np.log2(ends - starts + 1).astype(np.int64)
+
+    values = np.empty(n)
+    table = x.values
+    for level in range(int(levels.max()) + 1):
+        if level:
+            half = 1 << (level - 1)
+            table = op(table[:-half], table[half:])
+        rows = levels == level
+        values[rows] = op(table[starts[rows]], table[ends[rows] - (1 << level) + 1])
+    return Signal(x.ts, values)
+
+def rolling_min(x: Signal | float, window: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal):
+        return x
+    return rolling_extreme(np.fmin, x, seconds('rolling_min window', window))
+
+def rolling_max(x: Signal | float, window: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal):
+        return x
+    return rolling_extreme(np.fmax, x, seconds('rolling_max window', window))
+
+#mean of the samples in every period, stamped at the start of the period, empty periods are left out
+def resample(x: Signal | float, period: Signal | float) -> Signal | float:
+    if not isinstance(x, Signal) or len(x) == 0:
+        return x
+
+    width = seconds('resample period', period)
+    bucket = x.ts - x.ts % width
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    total = np.add.reduceat(np.nan_to_num(x.values), starts)
+    count = np.add.reduceat(~np.isnan(x.values), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return Signal(bucket[starts], total / count)
+
+def clip(x: Signal | float, low: Signal | float, high: Signal | float) -> Signal | float:
+    if isinstance(low, Signal) or isinstance(high, Signal):
+        raise ValueError('clip needs numbers for its limits')
+    return elementwise(lambda values: np.clip(values, low, high), x)
+
+def absolute(x: Signal | float) -> Signal | float:
+    return elementwise(np.abs, x)
+
+#sum of several tags sample by sample, a single tag is summed over the window into a constant
+def total(*args: Signal | float) -> Signal | float:
+    if len(args) == 1:
+        return float(np.nansum(args[0].values)) if isinstance(args[0], Signal) else args[0]
+    return reduce(lambda left, right: combine(np.add, left, right), args)
+
+#average of several tags sample by sample, a single tag is averaged over the window into a constant
+def average(*args: Signal | float) -> Signal | float:
+    if len(args) == 1:
+        if isinstance(args[0], Signal):
+            return float(np.nanmean(args[0].values)) if len(args[0]) else np.nan
+        return args[0]
+    return combine(np.divide, total(*args), float(len(args)))
+
+#functions whose result at a sample depends on the samples of the time argument (in seconds) before it,
+#mapped to the position of that argument, streamed evaluation reads this much history before every chunk
+WINDOWED = {
+    'rolling_mean': 1,
+    'rolling_min': 1,
+    'rolling_max': 1,
+    'rolling_std': 1,
+    'resample': 1,
+}
+
+#functions that accumulate over the whole window, streamed evaluation carries their last value into the next chunk
+CUMULATIVE = {'integral'}
+
+#name formulas use -> implementation
+FUNCTIONS = {
+    'derivative': derivative,
+    'integral': integral,
+    'rolling_mean': rolling_mean,
+    'rolling_min': rolling_min,
+    'rolling_max': rolling_max,
+    'rolling_std': rolling_std,
+    'resample': resample,
+    'clip': clip,
+    'abs': absolute,
+    'sum': total,
+    'avg': average,
+}
@@ -0,0 +1,175 @@
+from sqlite3 import Connection
+from io import BytesIO
+from typing import Callable, Iterator
+import hashlib
+import os
+import time
+
+import pandas as pd
+
+#number of bytes at the start of a file used to detect if the file was rewritten rather than appended to
+FINGERPRINT_BYTES = 65536
+
+#bytes of an uploaded csv parsed and written per transaction, bounds the memory an upload of any size needs
+UPLOAD_BATCH_BYTES = 8 * 1024 * 1024
+
+#creates the table used to remember how far into each source file we have already ingested
+def create_watermark_table(con: Connection) -> None:
+    with con:
+        con.execute("""CREATE TABLE IF NOT EXISTS ingest_watermarks (
+                            path TEXT PRIMARY KEY,
+                            size INTEGER NOT NULL,
+                            mtime REAL NOT NULL,
+                            offset INTEGER NOT NULL,
+                            fingerprint TEXT NOT NULL,
+                            last_time TEXT
+                        )""")
+
+def get_watermark(con: Connection, path: str) -> dict | None:
+    cur = con.execute("SELECT size, mtime, offset, fingerprint, last_time FROM ingest_watermarks WHERE path = ?", (path,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return {"size": row[0], "mtime": row[1], "offset": row[2], "fingerprint": row[3], "last_time": row[4]}
+
+def fingerprint(path: str, length: int) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(length, FINGERPRINT_BYTES))).hexdigest()
+
+#returns the offset just past the last complete line of the file at or after offset
+#the file is searched backwards from its end, a partially written last line is left for the next load
+def complete_end(path: str, offset: int) -> int:
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > offset:
+            start = max(offset, end - FINGERPRINT_BYTES)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline != -1:
+                return start + newline + 1
+            end = start
+    return offset
+
+#yields the rows of the file between offset and end as dataframes of about batch_bytes each
+#the file is parsed one batch at a time, so a rewritten file of any size never has to fit in memory
+def read_batches(path: str, columns: list[str], offset: int, end: int, batch_bytes: int = UPLOAD_BATCH_BYTES) -> Iterator[pd.DataFrame]:
+    chunker = CsvChunker(batch_bytes)
+    chunker.columns = columns
+
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = end - offset
+        while remaining > 0:
+            data = f.read(min(batch_bytes, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield from chunker.feed(data)
+    yield from chunker.close()
+
+def read_header(path: str) -> tuple[list[str], int]:
+    with open(path, "rb") as f:
+        header = f.readline()
+    return header.decode().strip().split(","), len(header)
+
+#ingests only the rows of the file that have not been loaded yet
+#append writes a dataframe of new rows (Time column + one column per tag) to the database
+#returns the number of new rows written to the database
+def ingest_csv(con: Connection, path: str, append: Callable[[Connection, pd.DataFrame], int]) -> int:
+    create_watermark_table(con)
+
+    stat = os.stat(path)
+    watermark = get_watermark(con, path)
+
+    #nothing changed since the last load, skip reading the file entirely
+    if watermark and watermark["size"] == stat.st_size and watermark["mtime"] == stat.st_mtime:
+        return 0
+
+    columns, header_length = read_header(path)
+
+    #if the file grew and its beginning is unchanged, only the appended bytes need to be read
+    #otherwise the file was rewritten, so reread it and rely on the last Time watermark to drop old rows
+    appended = (
+        watermark is not None
+        and stat.st_size >= watermark["size"]
+        and fingerprint(path, watermark["size"]) == watermark["fingerprint"]
+    )
+    offset = watermark["offset"] if appended else header_length
+    last_time = watermark["last_time"] if watermark else None
+
+    new_offset = complete_end(path, offset)
+
+    #every batch is written in its own transaction, rows are filtered against the watermark of the previous load
+    #so a file rewritten newest first still drops every old row
+    rows = 0
+    newest = last_time
+    for df in read_batches(path, columns, offset, new_offset):
+        #only keep rows newer than anything already ingested from this file
+        if last_time is not None:
+            df = df[df["Time"] > last_time]
+
+        if len(df):
+            rows += append(con, df)
+            batch_newest = df["Time"].max()
+            newest = batch_newest if newest is None else max(newest, batch_newest)
+    last_time = newest
+
+    with con:
+        con.execute("""INSERT OR REPLACE INTO ingest_watermarks (path, size, mtime, offset, fingerprint, last_time)
+                        VALUES (?, ?, ?, ?, ?, ?)""",
+                    (path, stat.st_size, stat.st_mtime, new_offset, fingerprint(path, stat.st_size), last_time))
+
+    return rows
+
+#splits a stream of csv bytes into dataframes of whole lines, the first line of the stream is the header
+#feed takes the bytes as they arrive and returns a dataframe whenever at least batch_bytes of complete lines are buffered
+class CsvChunker:
+    def __init__(self, batch_bytes: int = UPLOAD_BATCH_BYTES):
+        self.batch_bytes = batch_bytes
+        self.buffer = bytearray()
+        self.columns = None
+
+    def feed(self, data: bytes) -> list[pd.DataFrame]:
+        self.buffer += data
+        if len(self.buffer) < self.batch_bytes:
+            return []
+
+        #a line cut in half by the network stays in the buffer until the rest of it arrives
+        end = self.buffer.rfind(b"\n")
+        if end == -1:
+            return []
+        lines = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return self.parse(lines)
+
+    #parses whatever is left once the stream ended, the last line may have no newline
+    def close(self) -> list[pd.DataFrame]:
+        lines = bytes(self.buffer)
+        self.buffer.clear()
+        return self.parse(lines)
+
+    def parse(self, lines: bytes) -> list[pd.DataFrame]:
+        if self.columns is None:
+            header, _, lines = lines.partition(b"\n")
+            self.columns = header.decode().strip().split(",")
+        if not lines.strip():
+            return []
+        return [pd.read_csv(BytesIO(lines), header=None, names=self.columns)]
+
+#progress of one streamed upload, rows_per_second is the ingest throughput so far
+class UploadProgress:
+    def __init__(self, total_bytes: int = 0):
+        self.total_bytes = total_bytes
+        self.bytes = 0
+        self.rows = 0
+        self.started = time.perf_counter()
+        self.finished = None
+        self.error = None
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
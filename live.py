@@ -0,0 +1,44 @@
+import asyncio
+
+import numpy as np
+
+#seconds between two checks of data.csv for new rows while the server runs
+LIVE_POLL_SECONDS = 5
+
+#events a subscriber can fall behind before new ones are dropped for it, a stalled browser can't grow memory
+LIVE_QUEUE_SIZE = 100
+
+#fans newly ingested samples out to every open live stream
+#ingestion publishes each batch once from whatever thread it runs on, every subscriber gets it on its own queue
+class LiveHub:
+    def __init__(self):
+        self.loop = None
+        self.subscribers = set()
+
+    #called from the event loop once at startup, publish hands batches over to it
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        self.subscribers.discard(queue)
+
+    #publishes {tag name: (ts, values)} of newly written samples, safe to call from any thread
+    def publish(self, batch: dict[str, tuple[np.ndarray, np.ndarray]]) -> None:
+        if self.loop is None or not batch or not self.subscribers:
+            return
+        self.loop.call_soon_threadsafe(self.fan_out, batch)
+
+    def fan_out(self, batch: dict[str, tuple[np.ndarray, np.ndarray]]) -> None:
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(batch)
+            except asyncio.QueueFull:
+                pass
+
+#shared by the whole process
+hub = LiveHub()
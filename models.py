@@ -1,8 +1,8 @@
 from fastapi.responses import HTMLResponse
-from sqlite3 import Connection
 from datetime import datetime
 
 import pandas as pd
+import numpy as np
 import matplotlib.colors as mcolors
 import plotly.express as px
 import plotly.io as pio
@@ -10,13 +10,18 @@ import plotly.io as pio
 import re
 import random
 
+from downsample import MAX_POINTS
+
 
 class User:
-    def __init__(self, session_token: str, current_plots: list, time_frame: int, anchor_time: datetime):
+    def __init__(self, session_token: str, current_plots: list, time_frame: int, anchor_time: datetime, max_points: int = MAX_POINTS, downsample: str = "minmax"):
         self.session_token = session_token
         self.current_plots = current_plots
         self.time_frame = time_frame
         self.anchor_time = anchor_time
+        #maximum number of points per trace and the downsampling method, "exact" plots every sample
+        self.max_points = max_points
+        self.downsample = downsample
 
 
 class Tag:
@@ -31,20 +36,15 @@ class Tag:
             return random.choice(list(mcolors.CSS4_COLORS.keys()))
 
     @staticmethod
-    def plot(self, con_data: Connection, start_time: datetime, end_time: datetime) -> str:
+    def plot(self, ts: np.ndarray, values: np.ndarray) -> str:
         
         #validate tag.id to prevent SQL injection
         #only allow alphanumeric characters, underscores, and spaces (SQLite identifiers)
         if not re.match(r'^[a-zA-Z0-9_ ]+$', self.id):
             return HTMLResponse(f"Invalid tag ID format: {self.id}. Only alphanumeric characters, underscores, and spaces are allowed.")
         
-        #read the data from the database
-        df = pd.read_sql(f"""SELECT Time, "{self.id}"
-                            FROM process_data
-                            WHERE Time >= ? AND Time <= ? AND "{self.id}" IS NOT NULL""", con_data, params=(start_time, end_time))
-
-        #convert the tag_id column to numeric to ensure proper formatting
-        df[self.id] = pd.to_numeric(df[self.id], errors='coerce')
+        #ts is int64 epoch microseconds and values is float64, so the arrays are wrapped as-is without any parsing
+        df = pd.DataFrame({"Time": ts.astype("datetime64[us]"), self.id: values})
         fig = px.line(df, x="Time", y=self.id, title=f"{self.id}", labels={'Time': 'Time', self.id: 'Value'}, color_discrete_sequence=[self.color])
             
         #configure the plot to be dark mode with better contrast
@@ -55,6 +55,7 @@ class Tag:
             font=dict(color='#c9d1d9', size=12),
             title_font=dict(size=16, color='#e6edf3'),
             xaxis=dict(
+                type='date',
                 gridcolor='#30363d',
                 showgrid=False,
                 zeroline=False,
@@ -72,4 +73,5 @@ class Tag:
         #format hover tooltips to show 3 significant figures
         fig.update_traces(hovertemplate='%{x}<br>%{y:.3g}<extra></extra>')
 
-        return pio.to_html(fig, config={'responsive': True})
+        #plotly.js is loaded once by the page, so only the div and the trace data are returned
+        return pio.to_html(fig, include_plotlyjs=False, full_html=False, config={'responsive': True})
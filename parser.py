@@ -1,10 +1,19 @@
-from lark import Lark, Transformer
-import pandas as pd
-from database import get_df
-import sqlite3
+from lark import Lark, Transformer, Tree
+from lark.exceptions import VisitError
+from functools import lru_cache
+from typing import Callable
+import math
+import re
 import numpy as np
 
-con_data = sqlite3.connect("process_data.db")
+#numexpr is optional, without it elementwise chains run one numpy operation at a time
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from functions import CUMULATIVE, FUNCTIONS, WINDOWED, US_PER_SECOND
+from signals import DEFAULT_ALIGNMENT, Signal, combine
 
 #start the parsing at expression
 #expression is any term + or - any other term n(*) times
@@ -15,14 +24,19 @@ con_data = sqlite3.connect("process_data.db")
 
 #the operations defined within expression and term are mapped to the appropriate symbols
 
-#regex for operations like avg, derivative, add, subtract
-#regex for tagIDs in the form of two uppercase letters + 3 digits (PI001, TI001)
+#regex for operations like avg, derivative, lowercase so a function name can never look like a tag ID
+#regex for tagIDs, uppercase letters, digits and underscores starting with a letter (PI001, TI001)
 #regex for numbers, includes decimal points and digits after
 
+#the terminals don't overlap, which lets the grammar run on the much faster LALR parser
+
 #import whitespace definition
 #ignore it
 
-grammar = r"""
+#tag ids a formula can reference, new formula tags have to match it so other formulas can read them
+TAG_ID_PATTERN = r"[A-Z][A-Z0-9_]*"
+
+grammar = rf"""
 start: expression
 expression: term ((ADD | SUBTRACT) term)*
 term: factor ((MULTIPLY | DIVIDE) factor)*
@@ -38,167 +52,310 @@ SUBTRACT: "-"
 MULTIPLY: "*"
 DIVIDE: "/"
 
-OPERATION: /[a-zA-Z_][a-zA-Z0-9_]*/
-TAG_ID: /[A-Z]{2}[0-9]{3}/
+OPERATION: /[a-z_][a-z0-9_]*/
+TAG_ID: /{TAG_ID_PATTERN}/
 NUMBER: /[0-9]+(\.[0-9]+)?/
 
 %import common.WS
 %ignore WS
 """
 
-#create the formula transformer class
-class FormulaTransformer(Transformer):
-    #initialize the class, store the tags in a dictionary
+#numpy operation of every operator token
+OPERATORS = {
+    'ADD': np.add,
+    'SUBTRACT': np.subtract,
+    'MULTIPLY': np.multiply,
+    'DIVIDE': np.divide,
+}
+
+#symbol of every operator token in a fused numexpr expression
+SYMBOLS = {
+    'ADD': '+',
+    'SUBTRACT': '-',
+    'MULTIPLY': '*',
+    'DIVIDE': '/',
+}
+
+#one operation of a compiled formula, args are the indexes of the steps whose results it takes
+#op is "const" (value is the number), "tag" (value is the tag id), "binary" (value is the operator token type),
+#"call" (value is the function name) or "fused" (value is a Fused chain of binary operations)
+class Step:
+    def __init__(self, op: str, value, args: tuple[int, ...] = ()):
+        self.op = op
+        self.value = value
+        self.args = args
+
+#a chain of binary operations evaluated in one pass, source is the numexpr expression over the inputs a0, a1...
+#tree is the same expression as nested (operator token, left, right) tuples, an int leaf is an input and a float leaf a constant
+class Fused:
+    def __init__(self, source: str, tree):
+        self.source = source
+        self.tree = tree
+
+    #when every input signal shares its timestamps numexpr runs the whole chain in one pass without temporaries,
+    #otherwise the chain runs one aligned operation at a time like unfused steps
+    def run(self, inputs: list[Signal | float], alignment: str) -> Signal | float:
+        signals = [x for x in inputs if isinstance(x, Signal)]
+        if numexpr is not None and signals and all(np.array_equal(x.ts, signals[0].ts) for x in signals[1:]):
+            local_dict = {f'a{i}': x.values if isinstance(x, Signal) else x for i, x in enumerate(inputs)}
+            return Signal(signals[0].ts, numexpr.evaluate(self.source, local_dict=local_dict))
+        return self.evaluate(self.tree, inputs, alignment)
+
+    def evaluate(self, node, inputs: list[Signal | float], alignment: str) -> Signal | float:
+        if isinstance(node, tuple):
+            operator, left, right = node
+            return combine(OPERATORS[operator], self.evaluate(left, inputs, alignment), self.evaluate(right, inputs, alignment), alignment)
+        if isinstance(node, int):
+            return inputs[node]
+        return node
+
+#state a streamed evaluation carries from one chunk to the next
+#start and end are the chunk being produced (epoch microseconds, end exclusive), the window that is read reaches past both
+#offsets holds the (ts, value) of every cumulative step (by step index) and every cumulative input stitched by the caller
+#(by tag id) at the last sample of the previous chunk
+#with a checkpoint set, saved holds the same at the last sample at or before it, a later evaluation that starts after the
+#checkpoint continues from there instead of accumulating the whole history again
+class Carry:
+    def __init__(self, offsets: dict | None = None, checkpoint: int | None = None):
+        self.start = None
+        self.end = None
+        self.offsets = dict(offsets or {})
+        self.checkpoint = checkpoint
+        self.saved = {}
+
+    #continues a cumulative result from the value the previous chunk ended on and remembers where this chunk ends
+    def stitch(self, i: int | str, result: Signal | float) -> Signal | float:
+        if not isinstance(result, Signal) or len(result) == 0:
+            return result
+
+        if i in self.offsets:
+            ts, value = self.offsets[i]
+
+            #the window reaches back past the last sample of the previous chunk unless there is a long gap,
+            #then the result continues from the first sample of this chunk instead
+            k = np.searchsorted(result.ts, ts)
+            if k == len(result) or result.ts[k] != ts:
+                k = min(np.searchsorted(result.ts, self.start), len(result) - 1)
+            result = Signal(result.ts, result.values + (value - result.values[k]))
+
+        last = np.searchsorted(result.ts, self.end) - 1
+        if last >= 0:
+            self.offsets[i] = (int(result.ts[last]), float(result.values[last]))
+
+        if self.checkpoint is not None:
+            k = np.searchsorted(result.ts, self.checkpoint, side="right") - 1
+            if k >= 0 and (i not in self.saved or result.ts[k] >= self.start):
+                self.saved[i] = (int(result.ts[k]), float(result.values[k]))
+        return result
+
+#a formula compiled once into a list of steps in dependency order, the last step is the result
+#tags is the set of tag ids the formula reads, the plan holds no state so one plan is shared by every session and window
+class FormulaPlan:
+    def __init__(self, formula: str, steps: list[Step]):
+        self.formula = formula
+        self.steps = steps
+        self.tags = frozenset(step.value for step in steps if step.op == 'tag')
+
+        #cumulative results depend on the whole history before them
+        self.cumulative = any(step.op == 'call' and step.value in CUMULATIVE for step in steps)
+
+        #history in microseconds the result at a sample can depend on, windows of nested functions add up
+        self.lookback = sum(int(steps[step.args[WINDOWED[step.value]]].value * US_PER_SECOND) for step in steps
+                            if step.op == 'call' and step.value in WINDOWED and steps[step.args[WINDOWED[step.value]]].op == 'const')
+
+        #the results every step can drop once it ran because no later step reads them, keeps big windows from piling up
+        last_use = {}
+        for i, step in enumerate(steps):
+            for arg in step.args:
+                last_use[arg] = i
+        self.release = [tuple(arg for arg in set(step.args) if last_use[arg] == i) for i, step in enumerate(steps)]
+
+    #runs the plan, fetch returns the signal (or constant) of every referenced tag id for the window being evaluated
+    #all tags are fetched up front in one call, a tag used several times in the formula is only read once
+    #alignment is the policy used to line up signals with different sample times (see signals.ALIGNMENTS)
+    #carry is given when the plan runs chunk by chunk, cumulative functions then continue where the last chunk ended
+    def run(self, fetch: Callable[[frozenset[str]], dict[str, Signal | float]], alignment: str = DEFAULT_ALIGNMENT,
+            carry: Carry | None = None) -> Signal | float:
+        inputs = fetch(self.tags) if self.tags else {}
+
+        results = []
+        for step, release in zip(self.steps, self.release):
+            if step.op == 'const':
+                result = step.value
+            elif step.op == 'tag':
+                result = inputs[step.value]
+            elif step.op == 'binary':
+                left, right = (results[i] for i in step.args)
+                result = combine(OPERATORS[step.value], left, right, alignment)
+            elif step.op == 'fused':
+                result = step.value.run([results[i] for i in step.args], alignment)
+            else:
+                result = FUNCTIONS[step.value](*(results[i] for i in step.args))
+                if carry is not None and step.value in CUMULATIVE:
+                    result = carry.stitch(len(results), result)
+            results.append(result)
+
+            for i in release:
+                results[i] = None
+        return results[-1]
+
+#turns the parse tree into plan steps, every node method adds its step and returns the step index
+#operations on constants only are folded into a constant, and an operation that is already in the plan
+#(same op, value and inputs) returns the existing step so repeated subexpressions are computed once
+class PlanBuilder(Transformer):
     def __init__(self):
-        pass
+        super().__init__()
+        self.steps = []
+        self.index = {}
+
+    def add(self, op: str, value, args: tuple[int, ...] = ()) -> int:
+        if op in ('binary', 'call') and all(self.steps[i].op == 'const' for i in args):
+            operands = [self.steps[i].value for i in args]
+            if op == 'binary':
+                result = combine(OPERATORS[value], *operands)
+            else:
+                result = FUNCTIONS[value](*operands)
+            if not isinstance(result, Signal):
+                op, value, args = 'const', float(result), ()
+
+        key = (op, value, args)
+        if key not in self.index:
+            self.steps.append(Step(op, value, args))
+            self.index[key] = len(self.steps) - 1
+        return self.index[key]
 
     #when parser encounters the start node, return the expression result
     def start(self, args):
         return args[0]
 
-    #every time the parser encounters a number token, return the number as a float (parser returns strings only)
-    def NUMBER(self, token) -> float:
-        return float(token)
-    
-    #everyt time the parser encounters a tag ID, return the df object for that tag
-    def TAG_ID(self, token) -> pd.DataFrame:
-        tag_id = str(token)
-        tag_df = get_df(con_data, tag_id)
-        print(f"this is the tag df: {tag_df}")
-        return tag_df
-    
+    #every time the parser encounters a number token, add it as a constant (parser returns strings only)
+    def NUMBER(self, token) -> int:
+        return self.add('const', float(token))
+
+    #every time the parser encounters a tag ID, add a step that fetches the tag for the window
+    def TAG_ID(self, token) -> int:
+        return self.add('tag', str(token))
+
     #every time the parser encounters a factor node, return the factor
     def factor(self, args):
         return args[0]
-    
-    #every time the parser encounters a term node, perform term operation
-    #example input -> args = [<Signal A>, Token(MUL, '*'), <Signal B>, Token(DIV, '/'), <Signal C>]
+
+    #term and expression are chains of operators, folded left to right into binary steps
+    #example input -> args = [<step A>, Token(MULTIPLY, '*'), <step B>, Token(DIVIDE, '/'), <step C>]
     def term(self, args):
         result = args[0]
         i = 1
 
-        #as long as i is not out of range of the arguments list, continue to multiply and divide factors
+        #as long as i is not out of range of the arguments list, continue to add operator steps
         while i < len(args):
-
-            #declare the operator as a Lark token with built-in function .type that returns operator
             operator = args[i]
             right = args[i + 1]
-
-            #perform operations on two dataframes
-            if isinstance(result, pd.DataFrame) and isinstance(right, pd.DataFrame):
-                #get the data column names (non-Time columns) from each dataframe
-                result_data_col = [col for col in result.columns if col != 'Time'][0]
-                right_data_col = [col for col in right.columns if col != 'Time'][0]
-                
-                if operator.type == 'MULTIPLY':
-                    result[result_data_col] = result[result_data_col] * right[right_data_col]
-                elif operator.type == 'DIVIDE':
-                    result[result_data_col] = result[result_data_col] / right[right_data_col]
-
-            #perform operations on a dataframe and a constant
-            elif isinstance(result, pd.DataFrame):
-                for column in result.columns:
-                    if column != 'Time':
-                        if operator.type == 'MULTIPLY':
-                            result[column] = result[column] * right
-                        elif operator.type == 'DIVIDE':
-                            result[column] = result[column] / right
-            
-            #perform operations on a constant and a dataframe
-            elif isinstance(right, pd.DataFrame):
-                for column in right.columns:
-                    if column != 'Time':
-                        if operator.type == 'MULTIPLY':
-                            right[column] = right[column] * result
-                        elif operator.type == 'DIVIDE':
-                            right[column] = right[column] / result
-            
-            #perform operations on two constants
-            else:
-                if operator.type == 'MULTIPLY':
-                    result = result * right
-                elif operator.type == 'DIVIDE':
-                    result = result / right
+            result = self.add('binary', operator.type, (result, right))
 
             #index i by 2 to move along to the next operator and signal to the right of it
             i += 2
         return result
 
-    #when parser encounters an expression node, perform expression operation
-    #similar logic to term method
     def expression(self, args):
-        result = args[0]
-        i = 1
+        return self.term(args)
 
-        while i < len(args):
-
-            operator = args[i]
-            right = args[i + 1]
-
-            #perform operations on two dataframes
-            if isinstance(result, pd.DataFrame) and isinstance(right, pd.DataFrame):
-                #get the data column names (non-Time columns) from each dataframe
-                result_data_col = [col for col in result.columns if col != 'Time'][0]
-                right_data_col = [col for col in right.columns if col != 'Time'][0]
-                
-                if operator.type == 'ADD':
-                    result[result_data_col] = result[result_data_col] + right[right_data_col]
-                elif operator.type == 'SUBTRACT':
-                    result[result_data_col] = result[result_data_col] - right[right_data_col]
-
-            #perform operations on a dataframe and a constant
-            elif isinstance(result, pd.DataFrame):
-                for column in result.columns:
-                    if column != 'Time':
-                        if operator.type == 'ADD':
-                            result[column] = result[column] + right
-                        elif operator.type == 'SUBTRACT':
-                            result[column] = result[column] - right
-            
-            #perform operations on a constant and a dataframe
-            elif isinstance(right, pd.DataFrame):
-                for column in right.columns:
-                    if column != 'Time':
-                        if operator.type == 'ADD':
-                            right[column] = right[column] + result
-                        elif operator.type == 'SUBTRACT':
-                            right[column] = right[column] - result
-            
-            #perform operations on two constants
-            else:
-                if operator.type == 'ADD':
-                    result = result + right
-                elif operator.type == 'SUBTRACT':
-                    result = result - right
-            
-            #index i by 2 to move along to the next operator and signal to the right of it
-            i += 2
-        return result
-    
-    #when parser encounters a function node, perform function operation
-    #example input -> args = [Token(IDENTIFIER, 'max'), <Signal object for PI001>, <Signal object for TI042>]
+    #when parser encounters a function node, add a call step, unknown functions fail at compile time
+    #example input -> args = [Token(OPERATION, 'max'), <step for PI001>, <step for TI042>]
     def function(self, args):
         func_name = str(args[0])
-        func_args = args[1:]
+        if func_name not in FUNCTIONS:
+            raise ValueError(f'Unknown function: {func_name}')
+        return self.add('call', func_name, tuple(args[1:]))
+
+
+#keeps only the steps the result depends on, steps left behind by folding or fusing are dropped
+def prune(steps: list[Step], root: int) -> list[Step]:
+    keep = set()
+    stack = [root]
+    while stack:
+        i = stack.pop()
+        if i not in keep:
+            keep.add(i)
+            stack.extend(steps[i].args)
+
+    remap = {old: new for new, old in enumerate(sorted(keep))}
+    return [Step(steps[i].op, steps[i].value, tuple(remap[arg] for arg in steps[i].args)) for i in sorted(keep)]
+
+#merges chains of binary steps into fused steps that numexpr evaluates in a single pass
+#a binary step joins the chain of the step reading it when that is its only reader and also binary,
+#shared subexpressions stay separate steps so they are still computed once
+def fuse(steps: list[Step]) -> list[Step]:
+    readers = [[] for _ in steps]
+    for i, step in enumerate(steps):
+        for arg in step.args:
+            readers[arg].append(i)
+
+    inlined = {i for i, step in enumerate(steps)
+               if step.op == 'binary' and len(readers[i]) == 1 and steps[readers[i][0]].op == 'binary'}
 
-        if func_name == 'derivative':
-            print('hi')
-        
-        elif func_name == 'avg':
-            pass
-        
-        elif func_name == 'sum':
-            pass
+    fused = []
+    remap = {}
+    for i, step in enumerate(steps):
+        if i in inlined:
+            continue
 
+        if step.op == 'binary' and any(arg in inlined for arg in step.args):
+            leaves = []
+
+            def render(j: int):
+                node = steps[j]
+                if j == i or j in inlined:
+                    left_source, left_tree = render(node.args[0])
+                    right_source, right_tree = render(node.args[1])
+                    return f'({left_source} {SYMBOLS[node.value]} {right_source})', (node.value, left_tree, right_tree)
+                if node.op == 'const' and math.isfinite(node.value):
+                    return repr(node.value), node.value
+                if j not in leaves:
+                    leaves.append(j)
+                return f'a{leaves.index(j)}', leaves.index(j)
+
+            source, tree = render(i)
+            fused.append(Step('fused', Fused(source, tree), tuple(remap[j] for j in leaves)))
         else:
-            return(f'Unknown function: {func_name}')
+            fused.append(Step(step.op, step.value, tuple(remap[arg] for arg in step.args)))
+        remap[i] = len(fused) - 1
+
+    return prune(fused, len(fused) - 1)
+
+#build the LALR parser at import, cache=True stores the analysed grammar in a temp file so later startups load it instead of rebuilding it
+parser = Lark(grammar, start='start', parser='lalr', cache=True)
+
+#returns the parse tree of a formula, the same formula text is only parsed once
+@lru_cache(maxsize=1024)
+def parse_tree(expression: str) -> Tree:
+    return parser.parse(expression)
+
+#compiles a formula into a plan once, the same formula text from any session reuses the cached plan
+@lru_cache(maxsize=1024)
+def compile_formula(expression: str) -> FormulaPlan:
+    tree = parse_tree(expression)
+    builder = PlanBuilder()
 
+    #lark wraps errors raised while building in a VisitError, surface the original message
+    try:
+        root = builder.transform(tree)
+    except VisitError as e:
+        raise e.orig_exc
 
-parser = Lark(grammar, start='start')
+    steps = prune(builder.steps, root)
+    if numexpr is not None:
+        steps = fuse(steps)
+    return FormulaPlan(expression, steps)
 
-def parse_formula(expression: str) -> str:
-    tree = parser.parse(expression)
-    result = FormulaTransformer().transform(tree)
-    return result
+#evaluates the formula, fetch returns the signals (or constants) of the set of tag ids in it
+def parse_formula(expression: str, fetch: Callable[[frozenset[str]], dict[str, Signal | float]],
+                  alignment: str = DEFAULT_ALIGNMENT) -> Signal | float:
+    return compile_formula(expression).run(fetch, alignment)
 
+#returns True if the name can be used as a tag id in a formula
+def is_tag_id(name: str) -> bool:
+    return re.fullmatch(TAG_ID_PATTERN, name) is not None
 
+#returns the set of tag ids referenced by the formula without evaluating it, raises on a syntax error
+def formula_tags(expression: str) -> set[str]:
+    return set(compile_formula(expression).tags)
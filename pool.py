@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from sqlite3 import Connection
+from typing import Iterator
+import sqlite3
+import threading
+
+#path of the sqlite database
+DB_PATH = "process_data.db"
+
+#pragmas applied to every connection
+#WAL lets readers keep reading while the writer commits, NORMAL sync is safe with WAL and skips an fsync per commit
+#mmap and a 64 MB page cache keep hot pages out of read() calls, busy_timeout waits for other processes instead of failing
+PRAGMAS = [
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA busy_timeout = 30000",
+]
+
+#hands out one read connection per thread and a single writer connection shared behind a lock
+#several uvicorn workers can use the same database file, each process has its own pool and WAL keeps them from blocking readers
+class ConnectionPool:
+    def __init__(self, path: str = DB_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.write_lock = threading.Lock()
+        self.writer_con = None
+
+        #WAL only has to be switched on once per process, behind its own lock so readers never wait on a write
+        self.wal_lock = threading.Lock()
+        self.wal = False
+
+    def connect(self, check_same_thread: bool = True) -> Connection:
+        con = sqlite3.connect(self.path, timeout=30, check_same_thread=check_same_thread)
+        for pragma in PRAGMAS:
+            con.execute(pragma)
+        return con
+
+    #switches the database to WAL, journal_mode is stored in the file so later connections open in WAL as well
+    def enable_wal(self) -> None:
+        if self.wal:
+            return
+        with self.wal_lock:
+            if not self.wal:
+                con = self.connect()
+                con.execute("PRAGMA journal_mode = WAL")
+                con.close()
+                self.wal = True
+
+    def get_writer(self) -> Connection:
+        if self.writer_con is None:
+            self.enable_wal()
+            self.writer_con = self.connect(check_same_thread=False)
+        return self.writer_con
+
+    #returns the read connection of the current thread, query_only makes sure it is never used to write
+    def reader(self) -> Connection:
+        con = getattr(self.local, "con", None)
+        if con is None:
+            self.enable_wal()
+            con = self.local.con = self.connect()
+            con.execute("PRAGMA query_only = ON")
+        return con
+
+    #yields the writer connection, only one thread of the process writes at a time
+    @contextmanager
+    def writer(self) -> Iterator[Connection]:
+        with self.write_lock:
+            yield self.get_writer()
+
+#shared by the whole process
+pool = ConnectionPool()
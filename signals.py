@@ -0,0 +1,77 @@
+import numpy as np
+
+#how a signal is sampled at timestamps where it has no sample of its own
+#step holds the last sample (what a historian logs on change), linear interpolates between the two neighbouring samples
+#nearest takes whichever sample is closest in time
+ALIGNMENTS = ["step", "linear", "nearest"]
+DEFAULT_ALIGNMENT = "step"
+
+#a time series as two typed arrays, ts is int64 epoch microseconds and values is float64
+class Signal:
+    def __init__(self, ts: np.ndarray, values: np.ndarray):
+        self.ts = ts
+        self.values = values
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+#returns the values of a signal at the sorted timestamps ts, NaN where the policy gives no value
+#step is NaN before the first sample, linear and nearest are NaN outside the first and last sample
+def sample_at(signal: Signal, ts: np.ndarray, policy: str = DEFAULT_ALIGNMENT) -> np.ndarray:
+    if len(signal) == 0:
+        return np.full(len(ts), np.nan)
+
+    if policy == "linear":
+        #epoch microseconds stay exact as float64 until the year 2255
+        return np.interp(ts, signal.ts, signal.values, left=np.nan, right=np.nan)
+
+    if policy == "nearest":
+        right = np.clip(np.searchsorted(signal.ts, ts), 1, max(len(signal) - 1, 1))
+        left = right - 1
+        if len(signal) == 1:
+            index = np.zeros(len(ts), dtype=np.int64)
+        else:
+            index = np.where(ts - signal.ts[left] <= signal.ts[right] - ts, left, right)
+        inside = (ts >= signal.ts[0]) & (ts <= signal.ts[-1])
+        return np.where(inside, signal.values[index], np.nan)
+
+    #step, the last sample at or before every timestamp
+    index = np.searchsorted(signal.ts, ts, side="right") - 1
+    return np.where(index >= 0, signal.values[np.maximum(index, 0)], np.nan)
+
+#returns the common timeline of two signals and both of their values on it
+#the timeline is every timestamp of either signal within the span where both have a value under the policy
+def align(left: Signal, right: Signal, policy: str = DEFAULT_ALIGNMENT) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    #tags logged together share their timestamps, nothing to align
+    if len(left) == len(right) and np.array_equal(left.ts, right.ts):
+        return left.ts, left.values, right.values
+
+    if len(left) == 0 or len(right) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+
+    #both inputs are sorted, so the stable sort merges two runs in linear time
+    ts = np.sort(np.concatenate([left.ts, right.ts]), kind="stable")
+    ts = ts[np.r_[True, ts[1:] != ts[:-1]]]
+
+    #step holds the last value past the end of the shorter signal, the other policies stop where either signal stops
+    first = max(left.ts[0], right.ts[0])
+    last = max(left.ts[-1], right.ts[-1]) if policy == "step" else min(left.ts[-1], right.ts[-1])
+    ts = ts[(ts >= first) & (ts <= last)]
+
+    return ts, sample_at(left, ts, policy), sample_at(right, ts, policy)
+
+#applies a numpy binary operation to two operands that are each a signal or a constant
+#two signals are first aligned on time with the policy, so tags with different sample times or gaps combine correctly
+#the result is always a new signal, the inputs are never modified
+def combine(op: np.ufunc, left: Signal | float, right: Signal | float, policy: str = DEFAULT_ALIGNMENT) -> Signal | float:
+    if isinstance(left, Signal) and isinstance(right, Signal):
+        ts, left_values, right_values = align(left, right, policy)
+        return Signal(ts, op(left_values, right_values))
+
+    if isinstance(left, Signal):
+        return Signal(left.ts, op(left.values, right))
+
+    if isinstance(right, Signal):
+        return Signal(right.ts, op(left, right.values))
+
+    return float(op(left, right))
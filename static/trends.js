@@ -0,0 +1,64 @@
+// decodes a base64 string of little-endian float64 bytes sent by /series
+function decodeFloat64(b64) {
+    const bytes = Uint8Array.from(atob(b64), c => c.charCodeAt(0));
+    return new Float64Array(bytes.buffer);
+}
+
+// fetches the series of one open trend for the window and swaps its trace data in place
+async function refreshTrend(trend, window) {
+    const plot = trend.querySelector('.js-plotly-plot');
+    if (!plot) {
+        return;
+    }
+
+    const params = new URLSearchParams({ tag: trend.dataset.tag, start: window.start, end: window.end });
+    const response = await fetch('/series?' + params);
+    if (!response.ok) {
+        return;
+    }
+    const series = await response.json();
+
+    // keep the styling of the server rendered trace, only the data changes
+    const trace = Object.assign({}, plot.data[0], { x: decodeFloat64(series.x), y: decodeFloat64(series.y) });
+    Plotly.react(plot, [trace], plot.layout);
+}
+
+// the server answers time window changes with a trend-window event instead of re-rendering the plots
+document.addEventListener('trend-window', event => {
+    document.querySelectorAll('#plot-area .trend').forEach(trend => refreshTrend(trend, event.detail));
+});
+
+// appends pushed samples to the open trends, the window keeps its number of points so it slides with the data
+function extendTrends(event) {
+    const samples = JSON.parse(event.data);
+    document.querySelectorAll('#plot-area .trend').forEach(trend => {
+        const series = samples[trend.dataset.tag];
+        const plot = trend.querySelector('.js-plotly-plot');
+        if (!series || !plot) {
+            return;
+        }
+        const x = Array.from(decodeFloat64(series.x));
+        const y = Array.from(decodeFloat64(series.y));
+        Plotly.extendTraces(plot, { x: [x], y: [y] }, [0], Math.max(plot.data[0].x.length, x.length));
+    });
+}
+
+// live mode keeps one event stream open, the server pushes new samples of the plotted tags as they are ingested
+let liveSource = null;
+
+function setLive(enabled) {
+    if (liveSource) {
+        liveSource.close();
+        liveSource = null;
+    }
+    if (enabled) {
+        liveSource = new EventSource('/live');
+        liveSource.addEventListener('samples', extendTrends);
+    }
+}
+
+document.addEventListener('change', event => {
+    if (event.target.id === 'live-toggle') {
+        setLive(event.target.checked);
+    }
+});
@@ -0,0 +1,23 @@
+// sends the chosen csv as the raw request body so the server can parse it while it streams in
+// the progress is polled from /upload-progress until the upload request returns its summary
+async function uploadCsv(event) {
+    event.preventDefault();
+    const file = document.getElementById('upload-file').files[0];
+    if (!file) {
+        return;
+    }
+
+    const poll = setInterval(() => htmx.ajax('GET', '/upload-progress', { target: '#upload-progress', swap: 'outerHTML' }), 1000);
+    try {
+        const response = await fetch('/upload-csv', { method: 'POST', body: file, headers: { 'Content-Type': 'text/csv' } });
+        const summary = await response.text();
+        clearInterval(poll);
+        document.getElementById('upload-progress').outerHTML = summary;
+    } finally {
+        clearInterval(poll);
+    }
+}
+
+document.addEventListener('DOMContentLoaded', () => {
+    document.getElementById('upload-form').addEventListener('submit', uploadCsv);
+});
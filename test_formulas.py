@@ -0,0 +1,80 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from database import append_frame, create_formula_tag, create_schema, evaluate_formula, read_series, stream_formula
+from models import Tag
+
+#three weeks of samples every 10 minutes, streamed evaluation crosses several chunk boundaries
+#LZ and LI are lazy formula tags, LZ has a rolling window longer than the overlap read around every chunk
+@pytest.fixture
+def con(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    con = sqlite3.connect(tmp_path / "process_data.db")
+    create_schema(con)
+
+    time = pd.date_range("2025-01-01", periods=3 * 7 * 144, freq="10min")
+    phase = np.arange(len(time)) / 144 * 2 * np.pi
+    append_frame(con, pd.DataFrame({
+        "Time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "TI001": 1000 + 50 * np.sin(phase),
+        "PI001": 120 + 10 * np.cos(3 * phase),
+    }))
+
+    #FI001 is logged every 6 hours off the chunk boundaries, far less often than the overlap read around every chunk
+    sparse = time[18::36]
+    append_frame(con, pd.DataFrame({"Time": sparse.strftime("%Y-%m-%dT%H:%M:%S"), "FI001": np.arange(len(sparse), dtype=float)}))
+
+    create_formula_tag(con, Tag("LZ", None, "red"), "rolling_mean(TI001, 14400)")
+    create_formula_tag(con, Tag("LI", None, "red"), "integral(PI001)")
+    yield con
+    con.close()
+
+#streaming the history chunk by chunk has to give the same result as one pass over the whole history
+@pytest.mark.parametrize("formula", [
+    "rolling_mean(TI001, 3600) - PI001",
+    "integral(TI001) + rolling_max(PI001, 7200)",
+    "LZ * 1",
+    "rolling_mean(LZ, 3600) - TI001",
+    "LI * 2",
+    "TI001 - FI001",
+    "rolling_mean(TI001, 3600) * FI001",
+])
+def test_stream_matches_single_pass(con, formula):
+    ts, values = evaluate_formula(con, formula, None, None)
+    chunks = list(stream_formula(con, formula))
+
+    np.testing.assert_array_equal(np.concatenate([chunk.ts for chunk in chunks]), ts)
+    np.testing.assert_allclose(np.concatenate([chunk.values for chunk in chunks]), values, rtol=1e-9)
+
+#a materialized formula over a lazy tag is refreshed from far enough back when new samples arrive
+def test_refresh_reads_lazy_windows(con):
+    create_formula_tag(con, Tag("MZ", None, "red"), "LZ * 1", materialize=True)
+
+    time = pd.date_range("2025-01-22", periods=144, freq="10min")
+    append_frame(con, pd.DataFrame({"Time": time.strftime("%Y-%m-%dT%H:%M:%S"), "TI001": 900.0, "PI001": 100.0}))
+
+    ts, values = read_series(con, "MZ")
+    expected_ts, expected = evaluate_formula(con, "LZ * 1", None, None)
+    np.testing.assert_array_equal(ts, expected_ts)
+    np.testing.assert_allclose(values, expected, rtol=1e-9)
+
+#cumulative formulas continue from their saved carry on every append and still match a single pass
+@pytest.mark.parametrize("formula", ["integral(TI001)", "integral(TI001) * 2 + rolling_mean(PI001, 3600)", "LI * 2"])
+def test_refresh_continues_cumulative(con, formula):
+    create_formula_tag(con, Tag("MI", None, "red"), formula, materialize=True)
+
+    for start in pd.date_range("2025-01-22", periods=6, freq="1h"):
+        time = pd.date_range(start, periods=6, freq="10min")
+        append_frame(con, pd.DataFrame({"Time": time.strftime("%Y-%m-%dT%H:%M:%S"), "TI001": 900.0, "PI001": 100.0}))
+
+    ts, values = read_series(con, "MI")
+    expected_ts, expected = evaluate_formula(con, formula, None, None)
+    np.testing.assert_array_equal(ts, expected_ts)
+    np.testing.assert_allclose(values, expected, rtol=1e-9)
+
+def test_materialize_rejects_single_value(con):
+    with pytest.raises(ValueError):
+        create_formula_tag(con, Tag("AV", None, "red"), "avg(TI001)", materialize=True)
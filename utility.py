@@ -1,6 +1,23 @@
 import matplotlib.colors as mcolors 
 import random
 import uuid
+import base64
+from datetime import datetime, timedelta
+
+import numpy as np
+
+#timestamps are stored as integer microseconds since the unix epoch
+EPOCH = datetime(1970, 1, 1)
+
+def to_epoch_us(time: datetime) -> int:
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+def from_epoch_us(ts: int) -> datetime:
+    return EPOCH + timedelta(microseconds=ts)
+
+#encodes an array as base64 of its little-endian float64 bytes, decoded in the browser with a Float64Array
+def encode_float64(values: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(values, dtype="<f8").tobytes()).decode("ascii")
 
 def handle_cookie(session_token: str = None, user_sessions: dict = None) -> tuple[str, bool]:
 
@@ -0,0 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable
+import asyncio
+import os
+
+#threads that run the blocking sqlite, pandas and plotly work so the event loop stays free for other requests
+MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+#how many blocking jobs one session can have running at once, so one heavy request can't take every worker
+SESSION_CONCURRENCY = 4
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="rfnd-worker")
+
+#one semaphore per session, created on the first job of the session
+session_limits = {}
+
+def session_limit(key: str) -> asyncio.Semaphore:
+    if key not in session_limits:
+        session_limits[key] = asyncio.Semaphore(SESSION_CONCURRENCY)
+    return session_limits[key]
+
+#runs fn(*args) on the worker pool and waits for it without blocking the event loop
+#key is the session the job belongs to and limits how many jobs it runs in parallel
+async def run_blocking(key: str, fn: Callable[..., Any], *args: Any) -> Any:
+    async with session_limit(key):
+        return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args))